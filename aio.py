@@ -0,0 +1,47 @@
+"""
+Event loop support for the blocking API clients.
+
+The Splitwise and Mercado Pago SDKs and the WhatsApp client are built on requests, so the
+async facades run each call on a thread pool shared by the whole process and await it from
+the event loop. The pool is sized for hundreds of requests in flight; the rate limits of
+`call_api` and the connection pools of each client still bound what reaches every service.
+"""
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Blocking calls running at the same time, ASYNC_MAX_IN_FLIGHT on .env
+MAX_IN_FLIGHT = 200
+
+_executor: ThreadPoolExecutor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Get the thread pool shared by every awaited call of the process."""
+    global _executor  # pylint: disable=global-statement
+    with _executor_lock:
+        if _executor is None:
+            max_workers = int(os.getenv("ASYNC_MAX_IN_FLIGHT", MAX_IN_FLIGHT))
+            _executor = ThreadPoolExecutor(max(1, max_workers), thread_name_prefix="aio")
+        return _executor
+
+
+async def run_blocking(function, *args, **kwargs):
+    """Await a blocking call, run on the shared thread pool with the current context."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, function, *args, **kwargs)
+    return await loop.run_in_executor(get_executor(), call)
+
+
+def shutdown_executor() -> None:
+    """Wait for the running calls and drop the thread pool."""
+    global _executor  # pylint: disable=global-statement
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
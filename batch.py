@@ -0,0 +1,111 @@
+"""Batch operations that run the monthly payment flow for many users at once."""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from core import Bill, BillingMatrix, Contact, SendResult
+
+# Default number of users processed at the same time
+DEFAULT_WORKERS = 4
+
+
+def check_billing_matrix(user_id: int, billing_matrix: BillingMatrix) -> SendResult:
+    """Get the result of a user that can't be billed, or None if the matrix is valid."""
+    if not billing_matrix.is_valid:
+        return SendResult(
+            user_id=user_id, status="failed",
+            error=f"No expense found for the categories: "
+                  f"{', '.join(billing_matrix.missing_categories)}."
+        )
+    return None
+
+
+def check_bill(user_id: int, bill: Bill) -> SendResult:
+    """Get the result of a user without debts to bill, or None if the bill has debts."""
+    if bill is None or bill.total_cents <= 0:
+        return SendResult(user_id=user_id, status="no_debts")
+    return None
+
+
+def check_payment_link(user_id: int, payment_link: str) -> SendResult:
+    """Get the result of a user whose payment link was not created, or None if it was."""
+    if not payment_link:
+        return SendResult(user_id=user_id, status="failed", error="Payment link not created.")
+    return None
+
+
+def check_contact(user_id: int, payment_link: str, user_contact: Contact) -> SendResult:
+    """Get the result of a user without a phone number, or None if the user has one."""
+    if not user_contact.phone_number:
+        return SendResult(user_id=user_id, status="no_contact", payment_link=payment_link)
+    return None
+
+
+def get_message_result(user_id: int, payment_link: str, message_result) -> SendResult:
+    """Get the result of a user from the result of the WhatsApp message."""
+    if not message_result.sent:
+        return SendResult(
+            user_id=user_id, status="failed", payment_link=payment_link,
+            error=f"WhatsApp API error {message_result.status_code}: {message_result.error}"
+        )
+    return SendResult(user_id=user_id, status="sent", payment_link=payment_link)
+
+
+def send_payment_link_to_user(
+    external_services,
+    user_id: int,
+    bill: Bill,
+    user_contact: Contact
+) -> SendResult:
+    """Create the payment link for the user bill and send it to the user."""
+    try:
+        result = check_bill(user_id, bill)
+        if result:
+            return result
+
+        # Create payment link
+        payment_link, payment_items = external_services.create_payment_link(None, user_id, bill)
+        result = check_payment_link(user_id, payment_link) \
+            or check_contact(user_id, payment_link, user_contact)
+        if result:
+            return result
+
+        # Send to the user
+        message_result = external_services.send_debt_to_user(
+            user_contact, payment_link, payment_items, bill.template_values
+        )
+        return get_message_result(user_id, payment_link, message_result)
+    # Keep going with the other users
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        return SendResult(user_id=user_id, status="failed", error=str(e) or type(e).__name__)
+
+
+def send_payment_links(
+    data_access,
+    external_services,
+    user_ids: list[int],
+    workers: int = DEFAULT_WORKERS
+) -> list[SendResult]:
+    """Send the payment links to every given user using a bounded thread pool."""
+    # Get the bills and contacts of every user with a single fetch of each source
+    billing_matrix = data_access.get_billing_matrix(user_ids)
+    users_contacts = data_access.get_users_contacts(user_ids)
+
+    # Missing expenses are a data error, not members without debts
+    if not billing_matrix.is_valid:
+        return [check_billing_matrix(user_id, billing_matrix) for user_id in user_ids]
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [
+            executor.submit(
+                send_payment_link_to_user,
+                external_services, user_id, billing_matrix.bill(user_id),
+                users_contacts[user_id]
+            )
+            for user_id in user_ids
+        ]
+        for future in as_completed(futures):
+            results.append(future.result())
+
+    # Keep the same order as the given user IDs
+    order = {user_id: i for i, user_id in enumerate(user_ids)}
+    results.sort(key=lambda result: order[result.user_id])
+    return results
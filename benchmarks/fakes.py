@@ -0,0 +1,294 @@
+"""
+In-process stand-ins for the Splitwise client, the Mercado Pago SDK and the WhatsApp Graph API.
+
+The fakes answer with the same shapes used by the application, with configurable latency
+and error rates, and count every call so the benchmarks can report API calls per member.
+"""
+import itertools
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from core import ExpenseType
+
+CURRENT_USER_ID = 1
+
+
+class CallCounter:
+    """Thread-safe counter of the calls made to each fake endpoint."""
+    def __init__(self):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, endpoint: str) -> None:
+        """Count one call to the endpoint."""
+        with self._lock:
+            self.calls[endpoint] += 1
+
+    @property
+    def total(self) -> int:
+        """Total calls made to every endpoint."""
+        return sum(self.calls.values())
+
+
+class FakeService:
+    """Base of the fakes: latency, error injection and call counting."""
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.counter = CallCounter()
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+
+    def _call(self, endpoint: str) -> bool:
+        """Simulate a call to the endpoint. Return False when the call must fail."""
+        self.counter.add(endpoint)
+        if self.latency:
+            time.sleep(self.latency)
+        with self._random_lock:
+            return self._random.random() >= self.error_rate
+
+
+# Splitwise
+
+class FakeExpenseUser:
+    """User of a Splitwise expense."""
+    def __init__(self, user_id: int, net_balance: str):
+        self.id = user_id
+        self.net_balance = net_balance
+
+    def getNetBalance(self):  # pylint: disable=invalid-name
+        """Net balance of the user on the expense."""
+        return self.net_balance
+
+
+class FakeExpense:
+    """Splitwise expense."""
+    def __init__(self, expense_id: int, description: str, users: list, payment: bool = False):
+        self.id = expense_id
+        self.description = description
+        self.users = users
+        self.payment = payment
+
+    def getId(self):  # pylint: disable=invalid-name
+        """ID of the expense."""
+        return self.id
+
+    def getUsers(self):  # pylint: disable=invalid-name
+        """Users of the expense."""
+        return self.users
+
+
+class FakeBalance:
+    """Balance of a Splitwise friend in a currency."""
+    def __init__(self, amount: str, currency_code: str = "BRL"):
+        self.amount = amount
+        self.currency_code = currency_code
+
+    def getAmount(self):  # pylint: disable=invalid-name
+        """Amount of the balance."""
+        return self.amount
+
+    def getCurrencyCode(self):  # pylint: disable=invalid-name
+        """Currency of the balance."""
+        return self.currency_code
+
+
+class FakeFriend:
+    """Splitwise friend."""
+    def __init__(self, user_id: int, first_name: str, balance: float):
+        self.id = user_id
+        self.first_name = first_name
+        self.last_name = "Benchmark"
+        self.balances = [FakeBalance(f"{balance:.2f}")]
+
+    def getBalances(self):  # pylint: disable=invalid-name
+        """Balances of the friend."""
+        return self.balances
+
+
+class FakeCurrentUser:
+    """Splitwise user that owns the access token."""
+    id = CURRENT_USER_ID
+    first_name = "Benchmark"
+
+
+class FakeSplitwise(FakeService):
+    """Stand-in for the Splitwise client, with one monthly expense per ExpenseType."""
+    def __init__(self, members: int, **kwargs):
+        super().__init__(**kwargs)
+        self.member_ids = list(range(CURRENT_USER_ID + 1, CURRENT_USER_ID + 1 + members))
+        self._expense_ids = itertools.count(1)
+        self.created_expenses = []
+
+        # Each member owes a different value on each monthly expense
+        self.expenses = []
+        balances = Counter()
+        for position, expense_type in enumerate(ExpenseType):
+            users = []
+            for member_id in self.member_ids:
+                value = round(10 + (member_id * (position + 3)) % 90 + 0.5, 2)
+                balances[member_id] += value
+                users.append(FakeExpenseUser(member_id, f"-{value:.2f}"))
+            self.expenses.append(
+                FakeExpense(next(self._expense_ids), f"{expense_type.value} - benchmark", users)
+            )
+        self.friends = [
+            FakeFriend(member_id, f"Member{member_id}", balances[member_id])
+            for member_id in self.member_ids
+        ]
+
+    def getCurrentUser(self):  # pylint: disable=invalid-name
+        """Get the current user."""
+        self._call("splitwise.getCurrentUser")
+        return FakeCurrentUser()
+
+    def getFriends(self):  # pylint: disable=invalid-name
+        """Get every friend of the current user."""
+        self._call("splitwise.getFriends")
+        return self.friends
+
+    def getExpenses(self, offset=None, limit=None, **_filters):  # pylint: disable=invalid-name
+        """Get the expenses, newest first."""
+        self._call("splitwise.getExpenses")
+        offset = offset or 0
+        limit = limit or 20
+        return self.expenses[offset:offset + limit]
+
+    def createExpense(self, expense):  # pylint: disable=invalid-name
+        """Create an expense, failing with the configured error rate."""
+        if not self._call("splitwise.createExpense"):
+            return None, {"base": ["Simulated error"]}
+        created = FakeExpense(next(self._expense_ids), "created", [])
+        self.created_expenses.append(expense)
+        return created, None
+
+
+# Mercado Pago
+
+class FakePreferenceEndpoint:
+    """Stand-in for `sdk.preference()`."""
+    def __init__(self, sdk):
+        self.sdk = sdk
+
+    def create(self, preference_data, request_options=None):  # pylint: disable=unused-argument
+        """Create a preference, failing with the configured error rate."""
+        if not self.sdk._call("mercado_pago.preference.create"):  # pylint: disable=protected-access
+            return {"status": 500, "response": {"message": "Simulated error"}}
+        preference_id = f"bench-{next(self.sdk.preference_ids)}"
+        self.sdk.add_payment(preference_data)
+        return {
+            "status": 201,
+            "response": {
+                "id": preference_id,
+                "init_point": f"https://www.mercadopago.com.br/checkout?pref_id={preference_id}",
+                "external_reference": preference_data["external_reference"],
+            }
+        }
+
+
+class FakePaymentEndpoint:
+    """Stand-in for `sdk.payment()`."""
+    def __init__(self, sdk):
+        self.sdk = sdk
+
+    def search(self, filters=None, request_options=None):  # pylint: disable=unused-argument
+        """Search the payments, one page at a time."""
+        if not self.sdk._call("mercado_pago.payment.search"):  # pylint: disable=protected-access
+            return {"status": 500, "response": {"message": "Simulated error"}}
+        filters = filters or {}
+        results = [
+            payment for payment in self.sdk.payments
+            if payment["status"] == filters.get("status", payment["status"])
+        ]
+        offset = filters.get("offset", 0)
+        limit = filters.get("limit", 30)
+        return {
+            "status": 200,
+            "response": {
+                "results": results[offset:offset + limit],
+                "paging": {"total": len(results), "offset": offset, "limit": limit},
+            }
+        }
+
+    def get(self, payment_id, request_options=None):  # pylint: disable=unused-argument
+        """Get a payment by ID."""
+        if not self.sdk._call("mercado_pago.payment.get"):  # pylint: disable=protected-access
+            return {"status": 500, "response": {"message": "Simulated error"}}
+        for payment in self.sdk.payments:
+            if payment["id"] == int(payment_id):
+                return {"status": 200, "response": payment}
+        return {"status": 404, "response": {"message": "Payment not found"}}
+
+
+class FakeMercadoPagoSDK(FakeService):
+    """Stand-in for `mercadopago.SDK`. Every created preference is paid with paid_rate."""
+    def __init__(self, paid_rate: float = 1.0, **kwargs):
+        super().__init__(**kwargs)
+        self.paid_rate = paid_rate
+        self.preference_ids = itertools.count(1)
+        self.payment_ids = itertools.count(1000)
+        self.payments = []
+        self._payments_lock = threading.Lock()
+
+    def add_payment(self, preference_data: dict) -> None:
+        """Add an approved payment of the preference."""
+        with self._random_lock:
+            if self._random.random() >= self.paid_rate:
+                return
+        now = datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+        with self._payments_lock:
+            self.payments.append({
+                "id": next(self.payment_ids),
+                "status": "approved",
+                "external_reference": preference_data["external_reference"],
+                "transaction_amount": round(
+                    sum(item["unit_price"] for item in preference_data["items"]), 2
+                ),
+                "date_created": now,
+                "date_last_updated": now,
+            })
+
+    def preference(self):
+        """Preference endpoints."""
+        return FakePreferenceEndpoint(self)
+
+    def payment(self):
+        """Payment endpoints."""
+        return FakePaymentEndpoint(self)
+
+
+# WhatsApp
+
+class FakeResponse:
+    """Response of the fake WhatsApp Graph API."""
+    def __init__(self, status_code: int, body: dict):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {}
+        self.text = str(body)
+        self.content = self.text.encode("utf-8")
+
+    def json(self):
+        """Body of the response."""
+        return self.body
+
+
+class FakeWhatsAppSession(FakeService):
+    """Stand-in for the `requests.Session` used by the WhatsApp client."""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.headers = {}
+        self.hooks = {"response": []}
+        self._message_ids = itertools.count(1)
+
+    def mount(self, prefix, adapter):  # pylint: disable=unused-argument
+        """Ignore the connection pool adapter."""
+
+    # pylint: disable-next=unused-argument,redefined-outer-name
+    def post(self, url, json=None, timeout=None):
+        """Send a message, failing with the configured error rate."""
+        if not self._call("whatsapp.messages"):
+            return FakeResponse(500, {"error": {"message": "Simulated error", "code": 1}})
+        return FakeResponse(200, {"messages": [{"id": f"wamid.{next(self._message_ids)}"}]})
@@ -0,0 +1,220 @@
+"""
+End-to-end benchmark of the month close against the in-process fakes.
+
+Runs billing (expense snapshot and billing matrix), create_payment_link, send_debt_to_user,
+get_paid_debts, reconcile and send_payments for every member, at each member count, and
+reports the wall time, API calls per member and throughput of each stage. Every run uses a
+temporary working directory, so the logs and the state store never touch the real ones.
+
+Usage:
+    poetry run python benchmarks/month_close.py --members 10 1000 10000 --latency 0.005
+"""
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_PATH)
+
+# pylint: disable=wrong-import-position
+import data_access.csv_manager as csv_manager
+import external_services.mercado_pago as mercado_pago
+import external_services.whatsapp_api as whatsapp_api
+import ratelimit
+import state_store
+from benchmarks.fakes import (
+    CURRENT_USER_ID, FakeMercadoPagoSDK, FakeSplitwise, FakeWhatsAppSession
+)
+from core import BillingMatrix
+from data_access.splitwise import ExpenseSnapshot, send_payments
+from external_services import ExternalServices
+from logger import Logger
+from reconciliation import get_settlements, reconcile
+
+
+@contextmanager
+def quiet():
+    """Hide the prints of the application while a stage runs."""
+    with open(os.devnull, "w", encoding="utf-8") as devnull, redirect_stdout(devnull):
+        yield
+
+
+def write_contacts(member_ids: list[int]) -> None:
+    """Write the contacts CSV of the members."""
+    os.makedirs("data_access/src", exist_ok=True)
+    with open(csv_manager.CONTACTS_CSV_PATH, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["splitwise_id", "name", "phone_number"])
+        for member_id in member_ids:
+            writer.writerow([member_id, f"Member{member_id}", f"5511{member_id:09d}"])
+
+
+def reset_shared_state() -> None:
+    """Drop the objects shared by the modules, bound to the previous working directory."""
+    state_store._stores.clear()  # pylint: disable=protected-access
+    csv_manager._directories.clear()  # pylint: disable=protected-access
+    whatsapp_api._client = None  # pylint: disable=protected-access
+    ratelimit.rate_limiter.configure()
+
+
+def run_stage(name: str, members: int, fakes: list, function) -> dict:
+    """Run a stage and measure its wall time and API calls."""
+    calls_before = sum(fake.counter.total for fake in fakes)
+    start = time.perf_counter()
+    with quiet():
+        result = function()
+    elapsed = time.perf_counter() - start
+    calls = sum(fake.counter.total for fake in fakes) - calls_before
+    return {
+        "stage": name,
+        "members": members,
+        "seconds": elapsed,
+        "calls_per_member": calls / members,
+        "throughput": members / elapsed if elapsed else float("inf"),
+        "result": result,
+    }
+
+
+def run_month_close(
+    members: int, latency: float, error_rate: float, workers: int, rate_limits: bool = False
+) -> list[dict]:
+    """Run every stage of the month close for the given number of members."""
+    splitwise = FakeSplitwise(members, latency=latency, error_rate=error_rate)
+    sdk = FakeMercadoPagoSDK(latency=latency, error_rate=error_rate)
+    session = FakeWhatsAppSession(latency=latency, error_rate=error_rate)
+    fakes = [splitwise, sdk, session]
+
+    # Point the services to the fakes
+    reset_shared_state()
+    mercado_pago.PaymentData.settings = property(lambda self: sdk)
+    ratelimit.BACKOFF_SECONDS = 0.0
+    if not rate_limits:
+        # Only bound the concurrency, the fakes have no rate limits
+        ratelimit.rate_limiter.configure({}, (None, None, workers))
+    whatsapp_api._client = whatsapp_api.WhatsAppClient(  # pylint: disable=protected-access
+        "benchmark", "benchmark", max_concurrency=workers, session=session
+    )
+    write_contacts(splitwise.member_ids)
+
+    external_services = ExternalServices()
+    member_ids = splitwise.member_ids
+    stages = []
+
+    # Bills of every member
+    stage = run_stage(
+        "billing", members, fakes,
+        lambda: BillingMatrix.from_snapshot(ExpenseSnapshot(splitwise), member_ids).bills()
+    )
+    bills = stage.pop("result")
+    stages.append(stage)
+
+    # Payment links of every member
+    def create_links():
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(member_ids, executor.map(
+                lambda member_id: external_services.create_payment_link(
+                    None, member_id, bills[member_id]
+                ),
+                member_ids
+            )))
+    with Logger.buffered():
+        stage = run_stage("create_payment_link", members, fakes, create_links)
+    links = stage.pop("result")
+    stages.append(stage)
+
+    # WhatsApp messages to every member
+    contacts = csv_manager.get_contact_directory().get_contacts(member_ids)
+    def send_messages():
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(
+                lambda member_id: external_services.send_debt_to_user(
+                    contacts[member_id], *links[member_id], bills[member_id].template_values
+                ),
+                [member_id for member_id in member_ids if links[member_id][0]]
+            ))
+    with Logger.buffered():
+        stage = run_stage("send_debt_to_user", members, fakes, send_messages)
+    stage.pop("result")
+    stages.append(stage)
+
+    # Approved payments
+    stage = run_stage(
+        "get_paid_debts", members, fakes, lambda: external_services.get_paid_debts(full_scan=True)
+    )
+    paid_debts = stage.pop("result")
+    stages.append(stage)
+
+    # Payments matched with the payment links
+    stage = run_stage(
+        "reconcile", members, fakes, lambda: get_settlements(reconcile(paid_debts))
+    )
+    settlements = stage.pop("result")
+    stages.append(stage)
+
+    # Settlements on Splitwise
+    stage = run_stage(
+        "send_payments", members, fakes,
+        lambda: send_payments(splitwise, CURRENT_USER_ID, settlements, workers)
+    )
+    stage.pop("result")
+    stages.append(stage)
+    return stages
+
+
+def show_results(results: list[dict]) -> None:
+    """Print the benchmark results as a table."""
+    print(f"{'Members': >8} {'Stage': <22} {'Wall (s)': >10} {'Calls/member': >13} "
+          f"{'Members/s': >12}")
+    print("-" * 69)
+    for result in results:
+        print(
+            f"{result['members']: >8} {result['stage']: <22} {result['seconds']: >10.3f} "
+            f"{result['calls_per_member']: >13.3f} {result['throughput']: >12.1f}"
+        )
+
+
+def main() -> None:
+    """Run the month close benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument(
+        "--members", type=int, nargs="+", default=[10, 1000, 10000], help="Member counts.")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds added to each fake API call.")
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Share of fake API calls that fail.")
+    parser.add_argument("--workers", type=int, default=8, help="Members processed at once.")
+    parser.add_argument(
+        "--rate-limits", action="store_true", help="Apply the rate limits of the real APIs.")
+    args = parser.parse_args()
+
+    # Run with the credentials the services expect, without reading the real .env
+    os.environ.setdefault("ACCESS_TOKEN", "benchmark")
+    os.environ.setdefault("WHATSAPP_PHONE_NUMBER_ID", "benchmark")
+    os.environ.setdefault("WHATSAPP_ACCESS_TOKEN", "benchmark")
+    # Measure the API calls, not the Splitwise cache
+    os.environ["SPLITWISE_NO_CACHE"] = "1"
+
+    results = []
+    current_path = os.getcwd()
+    for members in args.members:
+        with tempfile.TemporaryDirectory() as working_path:
+            os.chdir(working_path)
+            try:
+                results.extend(
+                    run_month_close(
+                        members, args.latency, args.error_rate, args.workers, args.rate_limits
+                    )
+                )
+            finally:
+                reset_shared_state()
+                os.chdir(current_path)
+    show_results(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Startup benchmark of the Typer CLI.
+
+Measures the cold-start time of `python main.py --help` and of each command's `--help`
+(which loads the command without calling any API), and the import time of each module.
+
+Usage:
+    poetry run python benchmarks/startup.py --runs 5
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = [
+    "get-users",
+    "get-user-debts",
+    "create-payment-link",
+    "send-payment-link",
+    "send-payment-links",
+    "create-user-debts",
+    "get-paid-debts",
+    "month-status",
+    "month-close",
+    "month-close-all",
+    "serve-webhook",
+    "simulate-webhook",
+]
+
+# Modules of the project and the third party stacks they load
+MODULES = [
+    "typer",
+    "main",
+    "cli",
+    "core",
+    "data_access",
+    "config.splitwise_config",
+    "splitwise",
+    "external_services",
+    "external_services.mercado_pago",
+    "external_services.whatsapp_api",
+    "mercadopago",
+    "requests",
+    "dotenv",
+]
+
+
+def time_command(args: list[str], runs: int) -> list[float]:
+    """Run a command in a new interpreter and return the wall time of each run."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, *args],
+            cwd=ROOT_PATH, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False
+        )
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def import_time(module: str) -> float:
+    """Get the cumulative import time of a module in milliseconds, with a cold interpreter."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT_PATH, capture_output=True, text=True, check=False
+    )
+    if result.returncode != 0:
+        return None
+    # Lines have the format "import time: self [us] | cumulative | imported package"
+    for line in result.stderr.splitlines():
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1000
+    return None
+
+
+def main() -> None:
+    """Run the startup benchmark and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--runs", type=int, default=5, help="Runs of each command.")
+    args = parser.parse_args()
+
+    print(f"{'Command': <32} {'median (ms)': >12} {'min (ms)': >10}")
+    print("-" * 56)
+    targets = [("--help", ["main.py", "--help"])] + [
+        (f"{command} --help", ["main.py", command, "--help"]) for command in COMMANDS
+    ]
+    for label, command_args in targets:
+        times = time_command(command_args, args.runs)
+        print(
+            f"{label: <32} {statistics.median(times) * 1000: >12.1f} "
+            f"{min(times) * 1000: >10.1f}"
+        )
+
+    print()
+    print(f"{'Module': <32} {'import (ms)': >12}")
+    print("-" * 56)
+    for module in MODULES:
+        module_time = import_time(module)
+        value = f"{module_time: >12.1f}" if module_time is not None else f"{'not found': >12}"
+        print(f"{module: <32} {value}")
+
+
+if __name__ == "__main__":
+    main()
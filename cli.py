@@ -1,5 +1,8 @@
 """Interface for Splitwise API using Typer"""
-from core import Debt, ExpenseDebt, get_current_month
+from core import (
+    Debt, ExpenseDebt, ImportReport, Reconciliation, SendResult, TenantResult, format_cents,
+    get_current_month
+)
 
 
 class Cli:
@@ -19,11 +22,9 @@ class Cli:
         """Convert a list of Debt objects to a list of Debt objects."""
         # Initialize user debts
         if debts:
+            # Only the label changes for display, the value is kept in cents
             self.expense_debts = [
-                Debt(
-                    label=item.label.split()[0].capitalize(),
-                    value=float(item.value)  # Format value to Brazilian currency style
-                )
+                Debt(label=item.label.split()[0].capitalize(), cents=item.cents)
                 for item in debts
             ]
         else:
@@ -66,7 +67,7 @@ class Cli:
 
     def items_sum(self) -> float:
         """Calculate the sum of the values in the items."""
-        return sum(item.value for item in self.expense_debts)
+        return sum(item.cents for item in self.expense_debts) / 100
 
 
 def show_all_users(users: list[dict[str, str]]) -> None:
@@ -155,3 +156,117 @@ def show_created_payment(expense_debts: list[ExpenseDebt], title: str) -> None:
     print(cli.table_line())
     print(f"{'Total': <{content_width}} R$ {total_value: >{value_width}.2f}")
     print("\n")
+
+
+def show_import_report(report: ImportReport) -> None:
+    """Show the rows imported from the CSV file and the invalid ones"""
+    print(
+        f"Rows read: {report.rows} | Imported: {report.imported} | "
+        f"Merged duplicates: {report.merged} | Skipped: {report.skipped} | "
+        f"Errors: {len(report.errors)}"
+    )
+    for error in report.errors:
+        print(f"  {error}")
+
+
+def show_send_results(results: list[SendResult]) -> None:
+    """Show the result of sending the payment link to each user"""
+    if not results:
+        print("No users to display.")
+        return
+    cli = Cli()
+    print()
+    print(f"{f'ENVIOS - {get_current_month()}': ^{cli.full_width}}")
+    print(cli.table_line())
+    for result in results:
+        details = result.error or result.payment_link
+        print(
+            f"User ID: {result.user_id} | Status: {result.status}"
+            + (f" | {details}" if details else "")
+        )
+    print(cli.table_line())
+    sent = sum(1 for result in results if result.status == "sent")
+    print(f"Sent: {sent} | Not sent: {len(results) - sent}")
+    print("\n")
+
+
+def show_month_status(month: str, users_status: list[dict]) -> None:
+    """Show the payment cycle status of every user in the month"""
+    if not users_status:
+        print(f"No records found for the month {month}.")
+        return
+    cli = Cli()
+    print()
+    print(f"{f'STATUS - {month}': ^{cli.full_width}}")
+    print(cli.table_line())
+    for status in users_status:
+        paid = status["paid_amount"]
+        print(
+            f"User ID: {status['user_id']} | "
+            f"Link: {'yes' if status['payment_link'] else 'no'} | "
+            f"Message: {status['message_status'] or 'not sent'} | "
+            f"Paid: {f'R$ {paid:.2f}' if paid else 'no'} | "
+            f"Settlement: {status['settlement_status'] or 'no'}"
+        )
+    print(cli.table_line())
+    print("\n")
+
+
+def show_reconciliations(reconciliations: list[Reconciliation]) -> None:
+    """Show the payments of each reference matched with its payment link"""
+    if not reconciliations:
+        print("No new payments to reconcile.")
+        return
+    cli = Cli()
+    print()
+    print(f"{f'PAGAMENTOS - {get_current_month()}': ^{cli.full_width}}")
+    print(cli.table_line())
+    for reconciliation in reconciliations:
+        details = ""
+        if reconciliation.excess_cents:
+            details = f" | Refund: R$ {format_cents(reconciliation.excess_cents)}"
+        if reconciliation.status == "unmatched":
+            details = " | No payment link found"
+        print(
+            f"Reference: {reconciliation.external_reference} | "
+            f"Status: {reconciliation.status} | "
+            f"Paid: R$ {format_cents(reconciliation.paid_cents)} of "
+            f"R$ {format_cents(reconciliation.expected_cents)} | "
+            f"Settle: R$ {format_cents(reconciliation.settlement_cents)}{details}"
+        )
+    print(cli.table_line())
+    matched = sum(1 for reconciliation in reconciliations if reconciliation.status == "paid")
+    print(f"Paid: {matched} | To review: {len(reconciliations) - matched}")
+    print("\n")
+
+
+def show_tenant_results(tenant_results: list[TenantResult]) -> None:
+    """Show the month close of each tenant and the totals of every tenant"""
+    if not tenant_results:
+        print("No tenants to display.")
+        return
+    cli = Cli()
+    print()
+    print(f"{f'TENANTS - {get_current_month()}': ^{cli.full_width}}")
+    print(cli.table_line())
+    for tenant_result in tenant_results:
+        if tenant_result.error:
+            print(f"Tenant: {tenant_result.tenant} | Failed: {tenant_result.error}")
+            continue
+        settled = sum(
+            reconciliation.settlement_cents for reconciliation in tenant_result.reconciliations
+        )
+        print(
+            f"Tenant: {tenant_result.tenant} | "
+            f"Sent: {tenant_result.count('sent')} | "
+            f"No debts: {tenant_result.count('no_debts')} | "
+            f"No contact: {tenant_result.count('no_contact')} | "
+            f"Failed: {tenant_result.count('failed')} | "
+            f"Payments: {len(tenant_result.reconciliations)} | "
+            f"Settled: R$ {format_cents(settled)}"
+        )
+    print(cli.table_line())
+    failed = sum(1 for tenant_result in tenant_results if tenant_result.error)
+    sent = sum(tenant_result.count("sent") for tenant_result in tenant_results)
+    print(f"Tenants: {len(tenant_results) - failed} closed, {failed} failed | Sent: {sent}")
+    print("\n")
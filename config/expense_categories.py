@@ -0,0 +1,25 @@
+"""This module loads the expense categories billed each month."""
+import json
+import os
+from core import ExpenseClassifier, get_default_categories
+
+EXPENSE_CATEGORIES_PATH = "config/expense_categories.json"
+
+
+def load_expense_categories(path: str = EXPENSE_CATEGORIES_PATH) -> dict[str, list[str]]:
+    """Load the categories and their aliases, or a category per ExpenseType without the file.
+
+    The file maps each category to the descriptions that start its expenses, e.g.
+    {"Mensalidade": ["mensal"], "Almoço": ["almoco", "lunch"], "Geladeira": []}."""
+    if not os.path.exists(path):
+        return get_default_categories()
+    with open(path, "r", encoding="utf-8") as f:
+        categories = json.load(f)
+    if not isinstance(categories, dict) or not categories:
+        raise ValueError(f"{path} must map each category name to a list of aliases.")
+    return {str(category): list(aliases or []) for category, aliases in categories.items()}
+
+
+def get_expense_classifier(path: str = EXPENSE_CATEGORIES_PATH) -> ExpenseClassifier:
+    """Get the classifier of the configured categories."""
+    return ExpenseClassifier(load_expense_categories(path))
@@ -1,11 +1,17 @@
 """This module is responsible for configuring the Splitwise client."""
+import hashlib
 import json
 import os
 import sys
-from dotenv import load_dotenv # type: ignore
+from datetime import datetime, timedelta, timezone
 from splitwise import Splitwise
 from splitwise.exception import SplitwiseUnauthorizedException # type: ignore
+from config.tenants import load_env
+from core import SessionUser, file_lock
+from metrics import call_api
 ACCESS_TOKEN_PATH = "config/access_token.json"
+SESSION_PATH = "config/session.json"
+SESSION_TTL = timedelta(hours=12) # Time until the access token is verified again
 
 
 def pause() -> None:
@@ -25,14 +31,15 @@ def get_access_token(clt) -> None:
     The user will be redirected to a URL to authorize the application."""
 
     # Get the authorization URL
-    url, oauth_token_secret = clt.getAuthorizeURL()
+    url, oauth_token_secret = call_api("splitwise", "getAuthorizeURL", clt.getAuthorizeURL)
 
     # Print the URL to the console
     print("Please visit this URL to authorize the application: ", url)
     oauth_token = url.split("oauth_token=")[-1]
     oauth_verifier = input("Enter the oauth_verifier from the URL: ").strip()
     pause()
-    access_token = clt.getAccessToken(
+    access_token = call_api(
+        "splitwise", "getAccessToken", clt.getAccessToken,
         oauth_token, oauth_token_secret, oauth_verifier
     )
     save_access_token(access_token)
@@ -52,24 +59,75 @@ def check_file_access_token(clt):
     sys.exit()
 
 
-def verify_access_token(clt):
-    """Verify if the access token is valid."""
+def verify_access_token(clt) -> SessionUser:
+    """Verify if the access token is valid and return the current user."""
     try:
-        current_user = clt.getCurrentUser()
+        current_user = call_api("splitwise", "getCurrentUser", clt.getCurrentUser)
         print(f" User name: {current_user.first_name}, ID: {current_user.id}")
     except SplitwiseUnauthorizedException as e:
         print("Failed Verify: Access token is invalid.")
         print(f"Error: {e}\n")
-        print("Please delete the access token file and try again.\n")
+        print("Please check the Splitwise keys on .env file, "
+              "delete the access token file and try again.\n")
         os.remove(ACCESS_TOKEN_PATH)
         sys.exit()
     print("Access token is valid.\n")
-    return True
+    return SessionUser(id=current_user.id, first_name=current_user.first_name)
+
+
+def get_token_hash(token) -> str:
+    """Get a hash of the access token to bind the session to it."""
+    return hashlib.sha256(json.dumps(token, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def load_cached_session(token) -> SessionUser:
+    """Load the current user from the session file if it is still valid."""
+    if not os.path.exists(SESSION_PATH):
+        return None
+    try:
+        with open(SESSION_PATH, "r", encoding="utf-8") as f:
+            session = json.load(f)
+        verified_at = datetime.fromisoformat(session["verified_at"])
+        if session["token_hash"] != get_token_hash(token):
+            return None  # The access token changed since the last verification
+        if datetime.now(timezone.utc) - verified_at > SESSION_TTL:
+            return None  # The session expired
+        return SessionUser(**session["user"])
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def save_session(token, current_user: SessionUser) -> None:
+    """Save the verified current user to the session file."""
+    session = {
+        "user": {"id": current_user.id, "first_name": current_user.first_name},
+        "token_hash": get_token_hash(token),
+        "verified_at": datetime.now(timezone.utc).isoformat(),
+    }
+    # Write to a temporary file first so readers never see a partial session
+    temp_path = f"{SESSION_PATH}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(session, f)
+    os.replace(temp_path, SESSION_PATH)
+
+
+def load_session(clt, token) -> SessionUser:
+    """Get the current user from the session file or verify the access token once."""
+    # Lock the session so concurrent workers verify the access token only once
+    with file_lock(SESSION_PATH):
+        current_user = load_cached_session(token)
+        if current_user:
+            print(f"Session loaded. User name: {current_user.first_name}, ID: {current_user.id}\n")
+            return current_user
+
+        # Verify if the access token is valid
+        current_user = verify_access_token(clt)
+        save_session(token, current_user)
+    return current_user
 
 
 def load_access_token(clt) -> str:
-    """Check if the access token file exists, verify if the access token is valid,
-    and load the access token from the file."""
+    """Check if the access token file exists and load the access token from the file."""
     # Check if the access token file exists
     check_file_access_token(clt)
 
@@ -78,8 +136,6 @@ def load_access_token(clt) -> str:
         with open(ACCESS_TOKEN_PATH, "r", encoding="utf-8") as f:
             token = json.load(f)
             clt.setAccessToken(token)
-            # Verify if the access token is valid
-            verify_access_token(clt)
     except json.JSONDecodeError as e:
         print("Load access token failed.")
         print(f"Error: {e}")
@@ -92,7 +148,7 @@ def initialize_client() -> str:
     """Initialize the Splitwise client."""
 
     # Getting the environment variables from the .env file
-    load_dotenv()
+    load_env()
     consumer_key = os.getenv("CONSUMER_KEY")
     consumer_secret = os.getenv("CONSUMER_SECRET")
     api_key = os.getenv("API_KEY")
@@ -100,14 +156,6 @@ def initialize_client() -> str:
     # Set the Splitwise client
     clt = Splitwise(consumer_key, consumer_secret, api_key=api_key)
     print("\nEnvironment variables loaded successfully.\n")
-
-    # Check if the environment variables are set
-    try:
-        clt.getCurrentUser()
-    except SplitwiseUnauthorizedException as e:
-        print("Unauthorized access. Please set the correct Splitwise keys on .env file.\n")
-        print(e)
-        sys.exit()
     print("Client initialized successfully.\n")
     return clt
 
@@ -119,6 +167,8 @@ def config()-> tuple:
 
     # Load the access token from the file
     access_token = load_access_token(client)
-
     print("Access token loaded successfully.\n")
-    return client, access_token
+
+    # Get the current user, verifying the access token only when the session expired
+    current_user = load_session(client, access_token)
+    return client, access_token, current_user
@@ -0,0 +1,63 @@
+"""This module loads the tenant profiles, one per group with its own Splitwise account."""
+import json
+import os
+from dotenv import load_dotenv # type: ignore
+from core import Tenant
+
+TENANTS_PATH = "config/tenants.json"
+# Name of the tenant whose .env was loaded, also seen by the processes started from here
+ACTIVE_TENANT_ENV = "PAYMENT_CONTROL_TENANT"
+
+
+def load_tenants(path: str = TENANTS_PATH) -> dict[str, Tenant]:
+    """Load the tenant profiles by name.
+
+    The file maps each tenant to its directory and, optionally, its .env file within it, e.g.
+    {"fabrica": {"directory": "tenants/fabrica"}, "coworking": {"directory": "/srv/coworking",
+    "env": ".env.production"}}. Relative directories are relative to the current directory."""
+    if not os.path.exists(path):
+        raise ValueError(f"{path} not found. Add a profile for each tenant.")
+    with open(path, "r", encoding="utf-8") as f:
+        profiles = json.load(f)
+    if not isinstance(profiles, dict) or not profiles:
+        raise ValueError(f"{path} must map each tenant name to its profile.")
+
+    tenants = {}
+    for name, profile in profiles.items():
+        if not isinstance(profile, dict) or not profile.get("directory"):
+            raise ValueError(f"The profile of the tenant {name} must have a directory.")
+        directory = os.path.abspath(profile["directory"])
+        if not os.path.isdir(directory):
+            raise ValueError(f"The directory {directory} of the tenant {name} does not exist.")
+        env_path = os.path.join(directory, profile.get("env") or ".env")
+        tenants[name] = Tenant(name=name, directory=directory, env_path=env_path)
+    return tenants
+
+
+def get_tenant(name: str, path: str = TENANTS_PATH) -> Tenant:
+    """Get the profile of a tenant by name."""
+    tenants = load_tenants(path)
+    if name not in tenants:
+        raise ValueError(f"Tenant {name} not found in {path}. Tenants: {', '.join(tenants)}.")
+    return tenants[name]
+
+
+def use_tenant(tenant: Tenant) -> None:
+    """Run in the tenant directory, with the credentials of its .env.
+
+    Every path of the application is relative to the current directory, so the access token,
+    session, state, cache, logs and contacts of the tenant are used from here on."""
+    os.chdir(tenant.directory)
+    # The tenant credentials replace any loaded before
+    load_dotenv(tenant.env_path, override=True)
+    os.environ[ACTIVE_TENANT_ENV] = tenant.name
+
+
+def load_env() -> None:
+    """Load the .env of the project, unless the .env of a tenant is already loaded.
+
+    The .env is searched from the directory of the application, so without this check the
+    keys missing from the tenant .env would be taken from the project .env."""
+    if os.getenv(ACTIVE_TENANT_ENV):
+        return
+    load_dotenv()
@@ -1,11 +1,38 @@
 """Data classes for the core module."""
-from .data_classes import Debt, ExpenseDebt, Contact, get_current_month
+from .data_classes import (
+    Debt, ExpenseDebt, Contact, SessionUser, PaidDebt, MessageResult, SendResult, ImportReport,
+    Reconciliation, Tenant, TenantResult, get_current_month
+)
+from .file_lock import file_lock
+from .money import to_cents, apply_rate, format_cents, format_brl
 from .enum_classes import ExpenseType
+from .classifier import ExpenseClassifier, get_default_categories, normalize_text
+from .billing import TAX_PERCENT, TAXES_LABEL, Bill, BillingMatrix
 
 __all__ = [
     "Debt",
     "ExpenseDebt",
     "Contact",
+    "SessionUser",
+    "PaidDebt",
+    "MessageResult",
+    "SendResult",
+    "ImportReport",
+    "Reconciliation",
+    "Tenant",
+    "TenantResult",
     "get_current_month",
     "ExpenseType",
+    "file_lock",
+    "to_cents",
+    "apply_rate",
+    "format_cents",
+    "format_brl",
+    "ExpenseClassifier",
+    "get_default_categories",
+    "normalize_text",
+    "TAX_PERCENT",
+    "TAXES_LABEL",
+    "Bill",
+    "BillingMatrix",
 ]
@@ -0,0 +1,108 @@
+"""Billing of the monthly debts of every member, computed at once in integer cents."""
+from dataclasses import dataclass
+from .data_classes import Debt
+from .enum_classes import ExpenseType
+from .money import apply_rate, format_brl
+
+TAX_PERCENT = 0.0099 # Mercado Pago fee passed on to the members
+TAXES_LABEL = "Taxas"
+
+
+@dataclass(frozen=True, slots=True)
+class Bill:
+    """Monthly bill of a member: a debt per expense category, taxes and total."""
+    member_id: int
+    debts: tuple[Debt, ...]
+    taxes_cents: int
+    total_cents: int
+
+    @property
+    def items(self) -> list[Debt]:
+        """Get the payment items: the debts followed by the taxes."""
+        return [*self.debts, Debt(TAXES_LABEL, self.taxes_cents)]
+
+
+    @property
+    def template_values(self) -> dict[str, str]:
+        """Get the aligned values of the WhatsApp template, by lowercase label."""
+        values = {debt.label.lower(): format_brl(debt.cents) for debt in self.debts}
+        values[TAXES_LABEL.lower()] = format_brl(self.taxes_cents)
+        values["total"] = format_brl(self.total_cents)
+        return values
+
+
+class BillingMatrix:
+    """Members × categories matrix of debts in cents, with the taxes and totals of every row."""
+    def __init__(
+        self,
+        member_ids: list,
+        rows: list[list[int]],
+        labels: list[str] = None,
+        tax_percent: float = TAX_PERCENT,
+        missing_categories: list[str] = None
+    ):
+        # One column per expense category, an ExpenseType by default
+        self.labels = labels or [expense_type.value.lower() for expense_type in ExpenseType]
+        # Categories without an expense, which leave the matrix empty
+        self.missing_categories = list(missing_categories or [])
+        self.member_ids = list(member_ids)
+        self.rows = rows
+        self._positions = {member_id: i for i, member_id in enumerate(self.member_ids)}
+
+        # Compute every column of the bill in one pass over the rows
+        self.subtotals = [sum(abs(cents) for cents in row) for row in rows]
+        self.taxes = [apply_rate(subtotal, tax_percent) for subtotal in self.subtotals]
+        self.totals = [subtotal + taxes for subtotal, taxes in zip(self.subtotals, self.taxes)]
+
+
+    @classmethod
+    def from_snapshot(cls, snapshot, member_ids: list, **kwargs) -> "BillingMatrix":
+        """Build the matrix from an expense snapshot. It is empty if the snapshot is invalid."""
+        if not snapshot.is_valid:
+            return cls(
+                [], [], snapshot.labels, missing_categories=snapshot.missing_categories, **kwargs
+            )
+
+        # The snapshot columns are already in the order of the categories
+        zero_balances = [0] * len(snapshot.labels)
+        rows = [
+            list(snapshot.balances.get(member_id, zero_balances)) for member_id in member_ids
+        ]
+        return cls(member_ids, rows, snapshot.labels, **kwargs)
+
+
+    @property
+    def is_valid(self) -> bool:
+        """Check if every category had an expense, so the members can be billed."""
+        return not self.missing_categories
+
+
+    def __contains__(self, member_id) -> bool:
+        return member_id in self._positions
+
+
+    def bill(self, member_id) -> Bill:
+        """Get the bill of a member, or None if the member is not in the matrix."""
+        position = self._positions.get(member_id)
+        if position is None:
+            return None
+        return Bill(
+            member_id=member_id,
+            debts=tuple(
+                Debt(label=label, cents=cents)
+                for label, cents in zip(self.labels, self.rows[position])
+            ),
+            taxes_cents=self.taxes[position],
+            total_cents=self.totals[position],
+        )
+
+
+    def bills(self) -> dict[int, Bill]:
+        """Get the bill of every member."""
+        return {member_id: self.bill(member_id) for member_id in self.member_ids}
+
+
+    @property
+    def total_cents(self) -> int:
+        """Total billed to every member."""
+        return sum(self.totals)
@@ -0,0 +1,50 @@
+"""Classification of the Splitwise expenses into the monthly debt categories."""
+import unicodedata
+from .enum_classes import ExpenseType
+
+
+def normalize_text(text: str) -> str:
+    """Normalize a text for comparison: no accents or punctuation, case folded, single spaced."""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    words = "".join(
+        char if char.isalnum() else " "
+        for char in decomposed if not unicodedata.combining(char)
+    )
+    return " ".join(words.casefold().split())
+
+
+def get_default_categories() -> dict[str, list[str]]:
+    """Get a category for each ExpenseType, with its own name as the only alias."""
+    return {expense_type.value: [expense_type.value] for expense_type in ExpenseType}
+
+
+class ExpenseClassifier:
+    """Alias table that labels an expense description with its category."""
+    def __init__(self, categories: dict[str, list[str]] = None):
+        categories = categories or get_default_categories()
+        # Debt label of each category, in the configured order
+        self.labels = {category: category.lower() for category in categories}
+
+        # Normalize every alias once, the category name is always an alias
+        self.aliases: dict[str, str] = {}
+        for category, aliases in categories.items():
+            for alias in [category, *aliases]:
+                self.aliases.setdefault(normalize_text(alias), category)
+        self.max_alias_words = max(len(alias.split()) for alias in self.aliases)
+
+
+    @property
+    def categories(self) -> list[str]:
+        """Categories in the configured order."""
+        return list(self.labels)
+
+
+    def classify(self, description: str) -> str:
+        """Get the category of an expense description, matching its first words to an alias."""
+        words = normalize_text(description).split()
+        # Prefer the longest alias, e.g. "almoco extra" over "almoco"
+        for size in range(min(self.max_alias_words, len(words)), 0, -1):
+            category = self.aliases.get(" ".join(words[:size]))
+            if category:
+                return category
+        return None
@@ -1,5 +1,5 @@
 """This module contains data classes used in the application"""
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
 
 
@@ -8,19 +8,29 @@ def get_current_month() -> str:
     return datetime.now(timezone.utc).strftime("%m/%y")
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ExpenseDebt:
     """Class to represent user debt from a Splitwise expense."""
     id: str # User ID
     label: str # User name
-    value: float # User balance on the expense
+    cents: int # User balance on the expense, in cents
 
+    @property
+    def value(self) -> float:
+        """Get the value in reais."""
+        return self.cents / 100
 
-@dataclass
+
+@dataclass(frozen=True, slots=True)
 class Debt:
     """Class to represent user debt in the Splitwise API."""
     label: str
-    value: float
+    cents: int
+
+    @property
+    def value(self) -> float:
+        """Get the value in reais."""
+        return self.cents / 100
 
     @property
     def full_description(self) -> str:
@@ -34,3 +44,114 @@ class Contact:
     """Class to represent a contact in the WhatsApp API."""
     name: str
     phone_number: str
+    splitwise_id: str = ""
+
+
+@dataclass
+class SessionUser:
+    """Class to represent the Splitwise user that owns the access token."""
+    id: int
+    first_name: str
+
+
+@dataclass
+class PaidDebt:
+    """Class to represent an approved Mercado Pago payment of a user debt."""
+    user_id: int
+    external_reference: str # "{user_id}_{MM_YY}" reference of the payment link
+    payment_id: int = None
+    amount: float = 0.0
+    settlement_cents: int = None # Reconciled amount to settle, or the whole balance if None
+    payment_ids: tuple = () # Every payment covered by the settlement, only payment_id if empty
+
+    @property
+    def covered_payment_ids(self) -> tuple:
+        """Payments marked as settled once this debt is settled."""
+        return self.payment_ids or ((self.payment_id,) if self.payment_id is not None else ())
+
+
+@dataclass
+class MessageResult:
+    """Class to represent the result of sending a WhatsApp message."""
+    status: str # "sent" or "failed"
+    status_code: int = None
+    attempts: int = 0
+    message_id: str = ""
+    error: str = ""
+
+    @property
+    def sent(self) -> bool:
+        """Check if the message was sent."""
+        return self.status == "sent"
+
+
+@dataclass
+class SendResult:
+    """Class to represent the result of sending a payment link to a user."""
+    user_id: int
+    status: str # "sent", "no_debts", "no_contact" or "failed"
+    payment_link: str = ""
+    error: str = ""
+
+
+@dataclass
+class ImportReport:
+    """Class to represent the result of importing the user debts from a CSV file."""
+    rows: int = 0 # Rows read from the file
+    skipped: int = 0 # Rows of the current user
+    merged: int = 0 # Rows merged into a previous row of the same user
+    errors: list[str] = field(default_factory=list) # Invalid rows, by line number
+
+    @property
+    def imported(self) -> int:
+        """Number of rows imported."""
+        return self.rows - self.skipped - len(self.errors)
+
+
+@dataclass
+class Reconciliation:
+    """Class to represent the approved payments of a payment link, matched with the link."""
+    external_reference: str
+    user_id: int
+    status: str # "paid", "partial", "overpaid", "duplicate" or "unmatched"
+    expected_cents: int # Total of the payment link, with taxes
+    paid_cents: int
+    settlement_cents: int # Debts paid, without taxes, to settle on Splitwise
+    payment_ids: tuple = ()
+
+    @property
+    def excess_cents(self) -> int:
+        """Amount paid above the payment link total, to be refunded."""
+        return max(0, self.paid_cents - self.expected_cents) if self.expected_cents else 0
+
+    def to_paid_debt(self) -> PaidDebt:
+        """Get the paid debt to settle on Splitwise."""
+        return PaidDebt(
+            user_id=self.user_id,
+            external_reference=self.external_reference,
+            payment_id=self.payment_ids[0] if self.payment_ids else None,
+            amount=self.paid_cents / 100,
+            settlement_cents=self.settlement_cents,
+            payment_ids=self.payment_ids
+        )
+
+
+@dataclass
+class Tenant:
+    """Class to represent a group with its own Splitwise account, credentials and state."""
+    name: str
+    directory: str # Absolute path of the tenant .env, config/, state/, logs/ and data_access/src/
+    env_path: str # Absolute path of the tenant .env file
+
+
+@dataclass
+class TenantResult:
+    """Class to represent the month close of a tenant, run in its own worker process."""
+    tenant: str
+    results: list[SendResult] = field(default_factory=list)
+    reconciliations: list[Reconciliation] = field(default_factory=list)
+    error: str = ""
+
+    def count(self, status: str) -> int:
+        """Number of users with the given send status."""
+        return sum(1 for result in self.results if result.status == status)
@@ -0,0 +1,33 @@
+"""Inter-process file locking for files shared by concurrent workers."""
+import os
+from contextlib import contextmanager
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+
+@contextmanager
+def file_lock(path: str):
+    """Hold an exclusive lock on '<path>.lock' while the block runs."""
+    lock_path = f"{path}.lock"
+    directory = os.path.dirname(lock_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with open(lock_path, 'a+', encoding='utf-8') as lock_file:
+        # Block until the other workers release the lock
+        if os.name == 'nt':
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,27 @@
+"""Integer-cent money helpers and their presentation formats."""
+from decimal import Decimal, ROUND_HALF_UP
+from fractions import Fraction
+
+
+def to_cents(value) -> int:
+    """Convert a value in reais (float, str or Decimal) to integer cents."""
+    return int((Decimal(str(value)) * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+
+def apply_rate(cents: int, rate: float) -> int:
+    """Apply a rate (e.g. a tax percent) to a value in cents, rounding half up."""
+    # Exact integer arithmetic, without float or Decimal rounding on each value
+    rate = Fraction(str(rate))
+    value = (2 * abs(cents) * rate.numerator + rate.denominator) // (2 * rate.denominator)
+    return value if cents >= 0 else -value
+
+
+def format_cents(cents: int) -> str:
+    """Format cents as a decimal string, as expected by the APIs (e.g. "1234.50")."""
+    sign = "-" if cents < 0 else ""
+    return f"{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}"
+
+
+def format_brl(cents: int, width: int = len("0000,00")) -> str:
+    """Format cents in the Brazilian style, right aligned (e.g. "  12,50")."""
+    return format_cents(cents).replace(".", ",").rjust(width)
@@ -1,12 +1,19 @@
 """Data Access Layer for Splitwise API"""
+import threading
+from aio import run_blocking
 from config.splitwise_config import config
-from .splitwise import get_all_users, get_user_debts, create_user_debts, send_payments
-from .csv_manager import get_number_from_csv, get_debts_from_csv
+from core import BillingMatrix, ExpenseDebt, ImportReport, PaidDebt
+from .splitwise import (
+    DEFAULT_EXPENSE_WORKERS, ExpenseSnapshot, get_all_users, create_user_debts, send_payments
+)
+from .csv_manager import get_contact_directory, get_debts_from_csv
 
 class DataAccess:
     """Data Access Layer for Splitwise API"""
     def __init__(self):
-        self.client, self.access_token = config()
+        self.client, self.access_token, self.current_user = config()
+        self._snapshot = None
+        self._snapshot_lock = threading.Lock()
 
 
     def get_all_users(self):
@@ -14,28 +21,125 @@ class DataAccess:
         return get_all_users(self.client)
 
 
+    @property
+    def snapshot(self) -> ExpenseSnapshot:
+        """Expenses of the last 30 days, fetched once per Data Access instance."""
+        with self._snapshot_lock:
+            if self._snapshot is None:
+                self._snapshot = ExpenseSnapshot(self.client)
+        return self._snapshot
+
+
     def get_user_debts(self, user_id):
         """Get user debts from the last month by ID."""
-        return get_user_debts(self.client, user_id)
+        return self.snapshot.get_user_debts(user_id)
+
+
+    def get_users_debts(self, user_ids: list):
+        """Get the debts from the last month of many users with a single fetch."""
+        return self.snapshot.get_users_debts(user_ids)
+
+
+    def get_billing_matrix(self, user_ids: list) -> BillingMatrix:
+        """Get the bills of many users, computed at once from the expense snapshot."""
+        return BillingMatrix.from_snapshot(self.snapshot, user_ids)
 
 
     def get_user_contact(self, user_id):
         """Get user contact information from CSV file."""
-        return get_number_from_csv(user_id)
+        return get_contact_directory().get_contact(user_id)
+
 
+    def get_users_contacts(self, user_ids: list):
+        """Get the contact information of many users from CSV file."""
+        return get_contact_directory().get_contacts(user_ids)
 
-    def get_debts_from_csv(self, user_id: str = None, csv_path: str = None) -> tuple[list, float]:
-        """Get user debts from the CSV file."""
+
+    def get_debts_from_csv(
+        self, user_id: str = None, csv_path: str = None
+    ) -> tuple[list[ExpenseDebt], ImportReport]:
+        """Get user debts from the CSV file, skipping the current user by default."""
         if not csv_path:
             csv_path = "data_access/src/debts.csv"
+        if user_id is None:
+            user_id = self.current_user.id
         return get_debts_from_csv(csv_path, user_id)
 
 
-    def create_user_debts(self, csv_path, description, expenses: list = None):
+    def create_user_debts(
+        self, csv_path, description, expenses: list = None, workers: int = DEFAULT_EXPENSE_WORKERS
+    ):
+        """Send user debts to Splitwise API."""
+        return create_user_debts(
+            self.client, self.current_user.id, csv_path, description, expenses, workers
+        )
+
+
+    def send_payments(self, paid_debts: list[PaidDebt]):
+        """Send payments to the Splitwise API."""
+        return send_payments(self.client, self.current_user.id, paid_debts)
+
+
+class AsyncDataAccess:
+    """Data Access Layer for Splitwise API, awaited from an event loop.
+
+    Each call runs the blocking Data Access Layer on the shared thread pool of `aio`."""
+    def __init__(self, data_access: DataAccess = None):
+        self.data_access = data_access or DataAccess()
+
+
+    @property
+    def current_user(self):
+        """User of the Splitwise session."""
+        return self.data_access.current_user
+
+
+    async def get_all_users(self):
+        """Get users from Splitwise API"""
+        return await run_blocking(self.data_access.get_all_users)
+
+
+    async def get_user_debts(self, user_id):
+        """Get user debts from the last month by ID."""
+        return await run_blocking(self.data_access.get_user_debts, user_id)
+
+
+    async def get_users_debts(self, user_ids: list):
+        """Get the debts from the last month of many users with a single fetch."""
+        return await run_blocking(self.data_access.get_users_debts, user_ids)
+
+
+    async def get_billing_matrix(self, user_ids: list) -> BillingMatrix:
+        """Get the bills of many users, computed at once from the expense snapshot."""
+        return await run_blocking(self.data_access.get_billing_matrix, user_ids)
+
+
+    async def get_user_contact(self, user_id):
+        """Get user contact information from CSV file."""
+        return await run_blocking(self.data_access.get_user_contact, user_id)
+
+
+    async def get_users_contacts(self, user_ids: list):
+        """Get the contact information of many users from CSV file."""
+        return await run_blocking(self.data_access.get_users_contacts, user_ids)
+
+
+    async def get_debts_from_csv(
+        self, user_id: str = None, csv_path: str = None
+    ) -> tuple[list[ExpenseDebt], ImportReport]:
+        """Get user debts from the CSV file, skipping the current user by default."""
+        return await run_blocking(self.data_access.get_debts_from_csv, user_id, csv_path)
+
+
+    async def create_user_debts(
+        self, csv_path, description, expenses: list = None, workers: int = DEFAULT_EXPENSE_WORKERS
+    ):
         """Send user debts to Splitwise API."""
-        return create_user_debts(self.client, csv_path, description, expenses)
+        return await run_blocking(
+            self.data_access.create_user_debts, csv_path, description, expenses, workers
+        )
 
 
-    def send_payments(self, paid_users: list[int]):
+    async def send_payments(self, paid_debts: list[PaidDebt]):
         """Send payments to the Splitwise API."""
-        return send_payments(self.client, paid_users)
+        return await run_blocking(self.data_access.send_payments, paid_debts)
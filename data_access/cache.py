@@ -0,0 +1,107 @@
+"""
+Local read-through cache of the Splitwise reads.
+
+The friends and expenses read from Splitwise are kept in the 'state/cache/' directory for a
+short time per endpoint, so commands run back to back answer from the cache instead of
+calling the API again. Our own writes invalidate the cache, and setting SPLITWISE_NO_CACHE
+(the `--no-cache` flag) bypasses it.
+"""
+import glob
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+from datetime import timedelta
+from metrics import call_api
+
+CACHE_PATH = "state/cache"
+NO_CACHE_ENV = "SPLITWISE_NO_CACHE"
+# Time each endpoint is answered from the cache
+CACHE_TTLS = {
+    "getFriends": timedelta(minutes=10),
+    "getExpenses": timedelta(minutes=5),
+}
+
+
+def is_cache_enabled() -> bool:
+    """Check if the cache wasn't disabled with SPLITWISE_NO_CACHE."""
+    return os.getenv(NO_CACHE_ENV, "").strip().lower() not in ("1", "true", "yes")
+
+
+class ResponseCache:
+    """Responses of the Splitwise reads, stored as a pickle file per endpoint and parameters."""
+    def __init__(self, directory: str = CACHE_PATH, ttls: dict[str, timedelta] = None):
+        self.directory = directory
+        self.ttls = CACHE_TTLS if ttls is None else ttls
+        self._lock = threading.Lock()
+
+
+    def _path(self, endpoint: str, params: dict) -> str:
+        """Get the file of an endpoint and its parameters."""
+        key = hashlib.sha256(
+            json.dumps(params, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()[:16]
+        return os.path.join(self.directory, f"{endpoint}-{key}.pickle")
+
+
+    def get(self, endpoint: str, params: dict):
+        """Get the cached response, or None if it is missing or expired."""
+        path = self._path(endpoint, params)
+        try:
+            with open(path, "rb") as f:
+                stored_at, response = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError, AttributeError):
+            print(f"Skipping invalid cache file {path}.")
+            return None
+        if time.time() - stored_at > self.ttls[endpoint].total_seconds():
+            return None
+        return response
+
+
+    def set(self, endpoint: str, params: dict, response) -> None:
+        """Store a response."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(endpoint, params)
+        # Write to a temporary file first so a reader never loads a partial file
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            pickle.dump((time.time(), response), f)
+        os.replace(temp_path, path)
+
+
+    def call(self, endpoint: str, function, **params):
+        """Answer a Splitwise read from the cache, calling the API when it isn't cached."""
+        if endpoint not in self.ttls or not is_cache_enabled():
+            return call_api("splitwise", endpoint, function, **params)
+        response = self.get(endpoint, params)
+        if response is None:
+            response = call_api("splitwise", endpoint, function, **params)
+            self.set(endpoint, params, response)
+        return response
+
+
+    def invalidate(self, *endpoints: str) -> None:
+        """Remove the cached responses of the endpoints, or of every endpoint."""
+        with self._lock:
+            for endpoint in endpoints or self.ttls:
+                for path in glob.glob(os.path.join(self.directory, f"{endpoint}-*.pickle")):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+
+_caches: dict[str, ResponseCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_response_cache(directory: str = CACHE_PATH) -> ResponseCache:
+    """Get the response cache shared by every caller of the same directory."""
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = ResponseCache(directory)
+        return _caches[directory]
@@ -1,44 +1,127 @@
 """Get the information of contacts from a CSV file."""
 import csv
-from typing import List, Dict, Any
-from core import ExpenseDebt, Contact
+import os
+import threading
+from decimal import InvalidOperation
+from core import ExpenseDebt, Contact, ImportReport, to_cents
 
+CONTACTS_CSV_PATH = "data_access/src/contacts.csv"
 
-def get_number_from_csv(user_id) -> List[Dict[str, Any]]:
+
+def normalize_phone_number(phone_number: str) -> str:
+    """Keep only the digits of a phone number, as expected by the WhatsApp API."""
+    return "".join(char for char in phone_number if char.isdigit())
+
+
+class ContactDirectory:
+    """Contacts from a CSV file, indexed by Splitwise ID and reloaded when the file changes."""
+    def __init__(self, file_path: str = CONTACTS_CSV_PATH):
+        self.file_path = file_path
+        self.contacts: dict[str, Contact] = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+
+
+    def _load(self) -> None:
+        """Load the CSV file into the index if it changed since the last load."""
+        mtime = os.stat(self.file_path).st_mtime_ns
+        if mtime == self._mtime:
+            return
+
+        contacts = {}
+        # Open the CSV file and read its contents
+        with open(self.file_path, mode='r', newline='', encoding='utf-8') as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                splitwise_id = (row.get("splitwise_id") or "").strip()
+                if not splitwise_id or splitwise_id in contacts:
+                    continue  # Keep the first row of each user, as the linear scan did
+                contacts[splitwise_id] = Contact(
+                    name=(row.get("name") or "").strip(),
+                    phone_number=normalize_phone_number(row.get("phone_number") or ""),
+                    splitwise_id=splitwise_id
+                )
+        self.contacts = contacts
+        self._mtime = mtime
+
+
+    def get_contacts(self, user_ids: list) -> dict[str, Contact]:
+        """Get the contacts of many users, with an empty contact for the missing ones."""
+        with self._lock:
+            self._load()
+            contacts = self.contacts
+
+        users_contacts = {}
+        for user_id in user_ids:
+            user = contacts.get(str(user_id))
+            if not user or not user.name or not user.phone_number:
+                print(f"No contact found for user_id {user_id} in {self.file_path}")
+                user = Contact(name="", phone_number="", splitwise_id=str(user_id))
+            users_contacts[user_id] = user
+        return users_contacts
+
+
+    def get_contact(self, user_id) -> Contact:
+        """Get the contact of a user."""
+        return self.get_contacts([user_id])[user_id]
+
+
+_directories: dict[str, ContactDirectory] = {}
+_directories_lock = threading.Lock()
+
+
+def get_contact_directory(file_path: str = CONTACTS_CSV_PATH) -> ContactDirectory:
+    """Get the contact directory shared by every caller of the same CSV file."""
+    with _directories_lock:
+        if file_path not in _directories:
+            _directories[file_path] = ContactDirectory(file_path)
+        return _directories[file_path]
+
+
+def get_number_from_csv(user_id) -> Contact:
     """Get the contact information for a given user_id from a CSV file."""
-    user = Contact(name="", phone_number="")
-    file_path = "data_access/src/contacts.csv"
-    # Open the CSV file and read its contents
-    with open(file_path, mode='r', newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            if row.get("splitwise_id") == str(user_id):
-                # Insert the user name and phone number into the dictionary
-                user.name = row.get("name").strip()
-                user.phone_number = row.get("phone_number").strip()
-                break
-    if not user.name or not user.phone_number:
-        print(f"No contact found for user_id {user_id} in {file_path}")
-    return user
-
-
-def get_debts_from_csv(csv_path: str, user_id: str) -> tuple[list, float]:
-    """Load CSV file and return a dictionary with user IDs and their debts."""
+    return get_contact_directory().get_contact(user_id)
+
+
+def get_debts_from_csv(csv_path: str, user_id: str) -> tuple[list[ExpenseDebt], ImportReport]:
+    """Read the user debts from a CSV file in a single pass, merging the rows of each user.
+
+    Invalid rows don't stop the import: they are collected in the report with their line."""
+    report = ImportReport()
+    debts: dict[str, ExpenseDebt] = {}  # Keeps the order of the first row of each user
     with open(csv_path, newline='', encoding='utf-8') as csvfile:
         reader = csv.DictReader(csvfile)
-        expenses: list[ExpenseDebt] = []
         for row in reader:
-            if row["user_id"].strip() == user_id or row["user_id"].strip() == "":
-                print("Skipping the current user from the CSV file.")
+            report.rows += 1
+            line = reader.line_num
+            row_user_id = (row.get("user_id") or "").strip()
+            if user_id is not None and row_user_id == str(user_id):
+                report.skipped += 1  # The current user pays the expense
+                continue
+            if not row_user_id:
+                report.errors.append(f"Line {line}: missing user_id.")
                 continue
             try:
-                user_id = str(row["user_id"].strip())
-                amount = float(row["value"].strip().replace("R$", "").replace(",", "."))
-            except ValueError:
-                print(f"Failed to convert data: {row}")
+                amount = to_cents(
+                    (row.get("value") or "").replace("R$", "").replace(",", ".").strip()
+                )
+            except (ValueError, InvalidOperation):
+                report.errors.append(f"Line {line}: invalid value {row.get('value')!r}.")
+                continue
+            # A zero or negative debt makes Splitwise reject the whole expense of the chunk
+            if amount <= 0:
+                report.errors.append(f"Line {line}: value {row.get('value')!r} must be positive.")
                 continue
 
-            expenses.append(
-                ExpenseDebt(id=user_id, label=row["name"].strip(), value=amount)
-            )
-        return expenses
+            # Merge the rows of the same user into a single debt
+            previous = debts.get(row_user_id)
+            if previous:
+                report.merged += 1
+                debts[row_user_id] = ExpenseDebt(
+                    id=row_user_id, label=previous.label, cents=previous.cents + amount
+                )
+            else:
+                debts[row_user_id] = ExpenseDebt(
+                    id=row_user_id, label=(row.get("name") or "").strip(), cents=amount
+                )
+    return list(debts.values()), report
@@ -1,16 +1,35 @@
 """Data Access Layer for Splitwise API"""
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from itertools import islice
 from splitwise.expense import Expense
 from splitwise.user import ExpenseUser
-from core import Debt, ExpenseDebt, ExpenseType
+from config.expense_categories import get_expense_classifier
+from core import Debt, ExpenseClassifier, ExpenseDebt, PaidDebt, format_cents, to_cents
+from metrics import call_api
+from state_store import StateStore, get_state_store
+from .cache import get_response_cache
+
+# Number of payments posted to Splitwise at the same time
+DEFAULT_PAYMENT_WORKERS = 4
+# Debtors of each expense created from a CSV file, and expenses created at the same time
+MAX_EXPENSE_PARTICIPANTS = 50
+DEFAULT_EXPENSE_WORKERS = 4
+# Expenses requested per page
+EXPENSES_PAGE_SIZE = 50
+# Date windows of the expenses, SPLITWISE_EXPENSE_WINDOWS on .env, and windows fetched ahead
+DEFAULT_EXPENSE_WINDOWS = 1
+EXPENSE_WINDOWS_PREFETCH = 2
 
 
 class DebtProcessor:
     """Class to process user debts."""
-    def __init__(self, client = None, csv_path: str = None):
-        """Initialize the DebtProcessor with a Splitwise client and CSV path."""
+    def __init__(self, user_id: int = None, csv_path: str = None):
+        """Initialize the DebtProcessor with the current user ID and CSV path."""
         self.csv_path = csv_path if csv_path else None
-        self.user_id = client.getCurrentUser().id if client else None
+        self.user_id = user_id
 
 
     def to_dict(self, expenses: list[ExpenseDebt]) -> list[dict[str, str]]:
@@ -25,41 +44,15 @@ class DebtProcessor:
         ]
 
 
-    def get_total_amount(self, expenses: list[ExpenseDebt]) -> float:
-        """Get the total amount from a list of Debt objects."""
-        return sum(float(expense.value) for expense in expenses)
-
-
-    def verify_friend_balances(self, friend_balances: list[Debt]) -> bool:
-        """Verify if the friend balances match the expected expense types."""
-        if not friend_balances:
-            return False
-
-        # Get a list of expense types
-        expense_types = [expense.value.lower() for expense in ExpenseType]
-
-        # Check if each friend balance matches with an expense type
-        for balance in friend_balances:
-            balance.label = balance.label.split()[0].lower()  # Normalize the label to lowercase
-            for i, expense_type in enumerate(expense_types):
-                if expense_type == balance.label:
-                    # Remove the matched type to ensure one of each type is used
-                    del expense_types[i]
-                    break
-
-        if len(expense_types) == 0:
-            # All balances matched the expected expense types
-            return True
-
-        # If we reach here, a balance did not match any expense type
-        print("Not all balances matched the expected expense types.")
-        return False
+    def get_total_amount(self, expenses: list[ExpenseDebt]) -> int:
+        """Get the total amount in cents from a list of Debt objects."""
+        return sum(expense.cents for expense in expenses)
 
 
 def get_all_users(client):
     """Get all users from Splitwise API"""
     users = []
-    friends = client.getFriends()
+    friends = get_response_cache().call("getFriends", client.getFriends)
     for friend in friends:
         friend.id = friend.id or "Unknown"
         friend.first_name = friend.first_name or "Unknown"
@@ -74,165 +67,387 @@ def get_all_users(client):
     return users
 
 
-def get_user_debts(client, friend_id) -> list[Debt]:
-    """Get user debts from the last 30 days by ID."""
-    friend_balances = []
-    now = datetime.now()
-    thirty_days_ago = now - timedelta(days=30)
+def iter_expenses(
+    client, dated_after: datetime, dated_before: datetime = None,
+    page_size: int = EXPENSES_PAGE_SIZE
+):
+    """Yield the expenses of the date range, newest first, requesting one page at a time.
+
+    The next page is only requested when the consumer reaches it."""
+    filters = {"dated_after": dated_after.isoformat(timespec="seconds")}
+    if dated_before:
+        filters["dated_before"] = dated_before.isoformat(timespec="seconds")
+    offset = 0
+    while True:
+        expenses = get_response_cache().call(
+            "getExpenses", client.getExpenses, offset=offset, limit=page_size, **filters
+        )
+        yield from expenses or []
 
-    # Get the expenses from the last 30 days
-    expenses = client.getExpenses(dated_after=thirty_days_ago.strftime("%Y-%m-%d"), limit=100)
+        # Stop on the last page
+        if not expenses or len(expenses) < page_size:
+            return
+        offset += len(expenses)
 
-    # Get the friend debts
-    for expense in expenses:
-        if expense.payment:  # Skip payment expenses
-            continue
-        len_friend_balances = len(friend_balances)
 
-        # Find the debts for the specified friend
-        for user in expense.getUsers():
-            if user.id == friend_id:
+def iter_expenses_windowed(
+    client, dated_after: datetime, dated_before: datetime, windows: int,
+    page_size: int = EXPENSES_PAGE_SIZE, prefetch: int = EXPENSE_WINDOWS_PREFETCH
+):
+    """Yield the expenses of the date range, newest first, fetching date windows concurrently.
+
+    The range is split into windows, yielded from the newest. Only the next `prefetch`
+    windows are fetched ahead of the consumer, so the older windows are never requested
+    when the consumer stops early."""
+    if windows <= 1:
+        yield from iter_expenses(client, dated_after, dated_before, page_size)
+        return
+
+    # Split the range into windows, newest first
+    step = (dated_before - dated_after) / windows
+    ranges = iter([
+        (dated_before - step * (i + 1), dated_before - step * i) for i in range(windows)
+    ])
+
+    def fetch(window):
+        return list(iter_expenses(client, *window, page_size))
+
+    prefetch = max(1, min(prefetch, windows))
+    executor = ThreadPoolExecutor(max_workers=prefetch)
+    try:
+        futures = deque(executor.submit(fetch, window) for window in islice(ranges, prefetch))
+        # Skip the expenses on the boundary of two windows
+        seen_ids = set()
+        while futures:
+            expenses = futures.popleft().result()
+            # Start the next window while this one is consumed
+            for window in islice(ranges, 1):
+                futures.append(executor.submit(fetch, window))
+            for expense in expenses:
+                if expense.getId() not in seen_ids:
+                    seen_ids.add(expense.getId())
+                    yield expense
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ExpenseSnapshot:
+    """Expenses from the last 30 days, fetched once and indexed by user ID."""
+    def __init__(self, client, classifier: ExpenseClassifier = None, windows: int = None):
+        """Read the expenses of the last 30 days until every category is found."""
+        # Whole days, so the same reads of the day are answered by the cache
+        tomorrow = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) \
+            + timedelta(days=1)
+        thirty_days_ago = tomorrow - timedelta(days=31)
+        if windows is None:
+            windows = int(os.getenv("SPLITWISE_EXPENSE_WINDOWS") or DEFAULT_EXPENSE_WINDOWS)
+
+        # Get the expenses from the last 30 days, lazily
+        expenses = iter_expenses_windowed(client, thirty_days_ago, tomorrow, windows)
+
+        self.classifier = classifier or get_expense_classifier()
+        self.labels: list[str] = []
+        self.balances: dict[int, list[int]] = {}  # Balances in cents
+        self.missing_categories: list[str] = []
+        try:
+            self.is_valid = self._build_index(expenses)
+        finally:
+            # Stop the fetches that are no longer needed
+            expenses.close()
+
+
+    def _build_index(self, expenses) -> bool:
+        """Index the balances of every user on the newest expense of each category, in one pass."""
+        categories = self.classifier.categories
+        positions = {category: position for position, category in enumerate(categories)}
+        self.labels = [self.classifier.labels[category] for category in categories]
+
+        found = set()
+        for expense in expenses:
+            if expense.payment:  # Skip payment expenses
+                continue
+            category = self.classifier.classify(expense.description)
+            # Skip the other expenses and the older expenses of the same category
+            if category is None or category in found:
+                continue
+            found.add(category)
+
+            position = positions[category]
+            for user in expense.getUsers():
                 balance = user.getNetBalance()
-                if balance:  # Only append if there is a valid balance
-                    friend_balances.append(
-                        Debt(label=expense.description, value=abs(float(balance)))
-                    )
-                    break
+                if balance:  # Only index if there is a valid balance
+                    # Users that aren't in an expense keep a zero balance on it
+                    user_balances = self.balances.setdefault(user.id, [0] * len(categories))
+                    user_balances[position] = abs(to_cents(balance))
+
+            # Stop once every category has its expense
+            if len(found) == len(categories):
+                return True
 
-        # If the friend isn't in the expense, we append a zero balance
-        if len_friend_balances == len(friend_balances):
-            friend_balances.append(
-                Debt(label=expense.description, value=0.00)
-            )
+        self.missing_categories = [category for category in categories if category not in found]
+        print(f"No expense found for the categories: {', '.join(self.missing_categories)}.")
+        return False
 
-        # Stop after len(ExpenseType) valid expenses
-        if len(friend_balances) == len(ExpenseType):
-            # Verify if the friend balances match the expected expense types
-            debt_processor = DebtProcessor()
-            if debt_processor.verify_friend_balances(friend_balances):
-                return friend_balances
 
-    # If we reach here, it means we didn't find enough expenses for the friend
-    return None
+    def get_user_debts(self, user_id) -> list[Debt]:
+        """Get the debts of a user from the snapshot."""
+        if not self.is_valid:
+            return None
+        user_balances = self.balances.get(user_id, [0] * len(self.labels))
+        return [
+            Debt(label=label, cents=cents)
+            for label, cents in zip(self.labels, user_balances)
+        ]
 
 
-def create_user_debts(client, csv_path, description, expenses) -> tuple[list[dict], str]:
-    """Create a new expense based on a CSV file with user debts."""
+    def get_users_debts(self, user_ids: list) -> dict[int, list[Debt]]:
+        """Get the debts of many users from the snapshot."""
+        return {user_id: self.get_user_debts(user_id) for user_id in user_ids}
 
-    participants = []
-    total_amount = 0
-    user_id = client.getCurrentUser().id
-    debt_processor = DebtProcessor(client, csv_path)
-    total_amount = debt_processor.get_total_amount(expenses)
 
-    if total_amount <= 0:
-        print("Total amount is zero or negative. Aborting.")
-        return
-    if not expenses:
-        print("No expenses found in the CSV file. Aborting.")
-        return
+def get_user_debts(client, friend_id) -> list[Debt]:
+    """Get user debts from the last 30 days by ID."""
+    return ExpenseSnapshot(client).get_user_debts(friend_id)
+
 
+def build_expense(user_id, description, expenses: list[ExpenseDebt]) -> Expense:
+    """Build an expense paid by the current user and owed by each debtor."""
+    participants = []
     for expense in expenses:
         # Creates an ExpenseUser object for each participant
         user = ExpenseUser()
         user.setId(expense.id)
         user.setPaidShare("0.00")
-        user.setOwedShare(expense.value)
+        user.setOwedShare(format_cents(expense.cents))
         participants.append(user)
 
-    if not participants:
-        print("No valid participants found. Aborting.")
-        return
-
     # Adds the current user as the payer
+    total_amount = DebtProcessor().get_total_amount(expenses)
     payer = ExpenseUser()
     payer.setId(user_id)
-    payer.setPaidShare(str(total_amount))
+    payer.setPaidShare(format_cents(total_amount))
     payer.setOwedShare("0.00")
     participants.append(payer)
 
     expense = Expense()
-    expense.setCost(str(total_amount))
+    expense.setCost(format_cents(total_amount))
     expense.setDescription(description)
     expense.setUsers(participants)
+    return expense
+
 
-    created_expense, errors = client.createExpense(expense)
+def create_expense(client, user_id, description, expenses: list[ExpenseDebt]) -> bool:
+    """Create one expense on Splitwise. Return True if it was created."""
+    created_expense, errors = call_api(
+        "splitwise", "createExpense", client.createExpense,
+        build_expense(user_id, description, expenses)
+    )
 
     if created_expense and created_expense.getId():
-        print(f"Expense created successfully! ID: {created_expense.getId()}")
-        return expenses, description
-    print("Failed to create expense.")
+        print(f"Expense '{description}' created successfully! ID: {created_expense.getId()}")
+        return True
+    print(f"Failed to create expense '{description}'.")
     if errors:
         print("Errors:", errors)
     else:
         print("No specific error was returned.")
-    return [], description
+    return False
 
 
-def send_payments(client, paid_users: list[int]):
-    """Send payments of the paid users to the Splitwise API."""
-    if len(paid_users) == 0 or not paid_users:
-        print("No paid users found. Aborting.")
+def create_user_debts(
+    client, user_id, csv_path, description, expenses,
+    workers: int = DEFAULT_EXPENSE_WORKERS, max_participants: int = MAX_EXPENSE_PARTICIPANTS
+) -> tuple[list[ExpenseDebt], str]:
+    """Create the expenses of the user debts read from a CSV file.
+
+    Large participant sets are split into expenses of up to max_participants debtors,
+    created concurrently. Return the debts of the expenses that were created."""
+    debt_processor = DebtProcessor(user_id, csv_path)
+    total_amount = debt_processor.get_total_amount(expenses)
+
+    if total_amount <= 0:
+        print("Total amount is zero or negative. Aborting.")
+        return [], description
+    if not expenses:
+        print("No expenses found in the CSV file. Aborting.")
+        return [], description
+
+    # Split the debtors into expenses numbered as "description (1/3)"
+    chunks = [
+        expenses[i:i + max_participants] for i in range(0, len(expenses), max_participants)
+    ]
+    if len(chunks) == 1:
+        descriptions = [description]
+    else:
+        descriptions = [f"{description} ({i}/{len(chunks)})" for i in range(1, len(chunks) + 1)]
+
+    # Create the expenses through a bounded worker pool
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(chunks)))) as executor:
+        created = list(executor.map(
+            lambda job: create_expense(client, user_id, *job), zip(descriptions, chunks)
+        ))
+
+    # The balances and expenses changed
+    get_response_cache().invalidate()
+    if not all(created):
+        print(f"{created.count(False)} of {len(chunks)} expenses failed. "
+              "Remove the created debtors from the CSV file before importing it again.")
+    created_debts = [
+        expense for chunk, is_created in zip(chunks, created) if is_created for expense in chunk
+    ]
+    return created_debts, description
+
+
+def get_settlement_amount(paid_debt: PaidDebt, settled_cents: int, balance_cents: int) -> int:
+    """Get the cents to post for a paid debt: the reconciled amount not settled yet, capped
+    at the friend balance. Without a reconciled amount, the whole balance is settled."""
+    if paid_debt.settlement_cents is None:
+        return balance_cents
+    return min(paid_debt.settlement_cents - settled_cents, balance_cents)
+
+
+def send_payment(client, current_user_id, store: StateStore, user, paid_debt: PaidDebt):
+    """Send the payment of a paid user to the Splitwise API.
+
+    The amount settled for each reference is recorded, so a later payment of the same
+    reference, e.g. the rest of a partial payment, only posts the difference."""
+    user_id = paid_debt.user_id
+    external_reference = paid_debt.external_reference
+
+    # Get the amount already settled for the reference
+    entry = store.get_settlement(external_reference)
+    settled_amount = None
+    if entry:
+        if entry.get("status") == "pending":
+            print(f"The payment {external_reference} was interrupted on a previous run. "
+                  f"Verify it on Splitwise. Name {user.first_name}. ID {user_id}.")
+            return
+        settled_amount = entry.get("amount")
+        # Settled by the whole balance, or recorded before the amounts were
+        if paid_debt.settlement_cents is None or settled_amount is None:
+            print(f"The payment {external_reference} was already sent. "
+                  f"Name {user.first_name}. ID {user_id}.")
+            store.mark_payments_settled(paid_debt.covered_payment_ids)
+            return
+    settled_cents = to_cents(settled_amount) if settled_amount else 0
+
+    # Get the user's balance
+    user_balance = None
+    for balance in user.getBalances():
+        if balance.getCurrencyCode() == "BRL":
+            try:
+                user_balance = balance.getAmount()
+            except UnboundLocalError as e:
+                print(f"Error getting balance for user {user.first_name}. ID {user_id}: {e}")
+            break
+
+    # If the user has no balance or is already paid off, skip
+    if user_balance is None or to_cents(user_balance) <= 0:
+        print(f"The user is already paid off. Name {user.first_name}. ID {user_id}.")
+        store.mark_payments_settled(paid_debt.covered_payment_ids)
         return
 
-    friends = client.getFriends()
+    # Never post more than the reconciled amount, nor more than the user owes
+    amount_cents = get_settlement_amount(paid_debt, settled_cents, to_cents(user_balance))
+    if amount_cents <= 0:
+        print(f"The payment {external_reference} was already sent. "
+              f"Name {user.first_name}. ID {user_id}.")
+        store.mark_payments_settled(paid_debt.covered_payment_ids)
+        return
+    amount = format_cents(amount_cents)
 
-    for user_id in paid_users:
-        # Find the user in the friends list
-        user = None
-        for friend in friends:
-            if str(friend.id) == str(user_id):
-                user = friend
-                break
-        if not user:
-            print(f"User with ID {user_id} not found.")
-            continue
+    # Reserve the reference before posting, so a concurrent run never posts it again
+    if not store.reserve_settlement(external_reference, user_id, settled_amount):
+        print(f"The payment {external_reference} is already being sent.")
+        return
 
-        # Get the user's balance
-        user_balance = None
-        for balance in user.getBalances():
-            if balance.getCurrencyCode() == "BRL":
-                try:
-                    user_balance = balance.getAmount()
-                except UnboundLocalError as e:
-                    print(f"Error getting balance for user {user.first_name}. ID {user_id}: {e}")
-                break
-
-        # If the user has no balance or is already paid off, skip
-        if user_balance is None or float(user_balance) <= 0:
-            print(f"The user is already paid off. Name {user.first_name}. ID {user_id}.")
-            continue
+    # Creating payment
+    payment = Expense()
+    payment.setCost(amount)
+    payment.setDescription("Pagamento do Mês")
+    payment.setPayment(True)
+
+    # Friend
+    payer = ExpenseUser()
+    payer.setId(user_id)
+    payer.setPaidShare(amount)
+    payer.setOwedShare("0.00")
 
-        # Creating payment
-        payment = Expense()
-        payment.setCost(str(user_balance))
-        payment.setDescription("Pagamento do Mês")
-        payment.setPayment(True)
-
-        # Friend
-        payer = ExpenseUser()
-        payer.setId(user_id)
-        payer.setPaidShare(str(user_balance))
-        payer.setOwedShare("0.00")
-
-        # Current user
-        recipient = ExpenseUser()
-        recipient.setId(client.getCurrentUser().id)
-        recipient.setPaidShare("0.00")
-        recipient.setOwedShare(str(user_balance))
-
-        # Create the payment with both users
-        payment.setUsers([payer, recipient])
-        payment.setCurrencyCode("BRL")
-        created_payment, errors = client.createExpense(payment)
-
-        # Check if the payment was created successfully
-        if created_payment and created_payment.getId():
-            print(f"Payment sent for user {user.first_name}. ID {user_id}. Balance: {user_balance}")
+    # Current user
+    recipient = ExpenseUser()
+    recipient.setId(current_user_id)
+    recipient.setPaidShare("0.00")
+    recipient.setOwedShare(amount)
+
+    # Create the payment with both users
+    payment.setUsers([payer, recipient])
+    payment.setCurrencyCode("BRL")
+    try:
+        created_payment, errors = call_api(
+            "splitwise", "createExpense", client.createExpense, payment
+        )
+    except Exception:
+        store.release_settlement(external_reference)
+        raise
+
+    # Check if the payment was created successfully
+    if created_payment and created_payment.getId():
+        store.complete_settlement(
+            external_reference, created_payment.getId(), format_cents(settled_cents + amount_cents)
+        )
+        store.mark_payments_settled(paid_debt.covered_payment_ids)
+        print(f"Payment sent for user {user.first_name}. ID {user_id}. Amount: {amount}")
+    else:
+        store.release_settlement(external_reference)
+        print(f"Failed to send payment for user {user.first_name}. ID {user_id}.")
+        if errors:
+            print("Errors:", errors)
         else:
-            print(f"Failed to send payment for user {user.first_name}. ID {user_id}.")
-            if errors:
-                print("Errors:", errors)
-            else:
-                print("No specific error was returned.")
-        print()
+            print("No specific error was returned.")
+
+
+def send_payments(
+    client, current_user_id, paid_debts: list[PaidDebt], workers: int = DEFAULT_PAYMENT_WORKERS
+):
+    """Send payments of the paid users to the Splitwise API."""
+    if not paid_debts:
+        print("No paid users found. Aborting.")
+        return
+
+    # Index the friends by ID once
+    friends = {
+        str(friend.id): friend
+        for friend in call_api("splitwise", "getFriends", client.getFriends)
+    }
+    store = get_state_store()
+
+    # Keep one payment per external reference
+    unique_debts = {}
+    for paid_debt in paid_debts:
+        unique_debts.setdefault(paid_debt.external_reference, paid_debt)
+
+    jobs = []
+    for paid_debt in unique_debts.values():
+        user = friends.get(str(paid_debt.user_id))
+        if not user:
+            print(f"User with ID {paid_debt.user_id} not found.")
+            continue
+        jobs.append((user, paid_debt))
+
+    # Post the payments through a bounded worker pool
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {
+            executor.submit(
+                send_payment, client, current_user_id, store, user, paid_debt
+            ): paid_debt
+            for user, paid_debt in jobs
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                print(f"Failed to send payment for user ID {futures[future].user_id}: {e}")
+
+    # The balances and expenses changed
+    get_response_cache().invalidate()
+    print()
@@ -1,27 +1,96 @@
-"""External Services Layer for handling payment links and sending debts to users."""
-from .mercado_pago import create_payment_link, get_paid_debts
-from .whatsapp_api import send_debt_to_user
+"""External Services Layer for handling payment links and sending debts to users.
+
+Mercado Pago and WhatsApp modules are imported on the first use of each service, so a
+command that only creates payment links never loads the WhatsApp stack and vice versa."""
+# pylint: disable=import-outside-toplevel
+from aio import run_blocking
 
 class ExternalServices:
     """External Services Layer for handling payment links and sending debts to users."""
     def __init__(self):
         self.services = {}
 
-    def create_payment_link(self, user_debts, user_id) -> tuple[str, list[dict[str, float]]]:
-        """Get the payment link for the given user_debts."""
-        return create_payment_link(user_debts, user_id)
+    def create_payment_link(
+        self, user_debts, user_id, bill=None
+    ) -> tuple[str, list[dict[str, float]]]:
+        """Get the payment link for the given user_debts, or for the bill of the user."""
+        from .mercado_pago import create_payment_link
+        return create_payment_link(user_debts, user_id, bill)
 
 
     def send_debt_to_user(
         self,
         user_contact: dict[str, str],
         payment_link: str,
-        payment_items: list[dict[str, float]]
+        payment_items: list[dict[str, float]],
+        template_values: dict[str, str] = None
     ):
         """Send the payment link and items to the user."""
-        send_debt_to_user(user_contact, payment_link, payment_items)
+        from .whatsapp_api import send_debt_to_user
+        return send_debt_to_user(user_contact, payment_link, payment_items, template_values)
+
+
+    def get_paid_debts(self, full_scan: bool = False):
+        """Get the paid debts not read by previous runs, or every paid debt with full_scan."""
+        from .mercado_pago import PaymentCursor, get_paid_debts
+        self.services["payment_cursor"] = PaymentCursor()
+        return get_paid_debts(self.services["payment_cursor"], full_scan)
+
+
+    def get_paid_debt(self, payment_id):
+        """Get the paid debt of a single payment, as notified by Mercado Pago."""
+        from .mercado_pago import get_paid_debt
+        return get_paid_debt(payment_id)
+
+
+    def save_payment_cursor(self):
+        """Save the position of the last paid debt read, after processing them."""
+        if "payment_cursor" in self.services:
+            self.services["payment_cursor"].save()
+
+
+class AsyncExternalServices:
+    """External Services Layer awaited from an event loop.
+
+    Each call runs the blocking External Services Layer on the shared thread pool of `aio`,
+    so many payment links and messages are in flight at once."""
+    def __init__(self, external_services: ExternalServices = None):
+        self.external_services = external_services or ExternalServices()
+
+
+    async def create_payment_link(
+        self, user_debts, user_id, bill=None
+    ) -> tuple[str, list[dict[str, float]]]:
+        """Get the payment link for the given user_debts, or for the bill of the user."""
+        return await run_blocking(
+            self.external_services.create_payment_link, user_debts, user_id, bill
+        )
+
+
+    async def send_debt_to_user(
+        self,
+        user_contact: dict[str, str],
+        payment_link: str,
+        payment_items: list[dict[str, float]],
+        template_values: dict[str, str] = None
+    ):
+        """Send the payment link and items to the user."""
+        return await run_blocking(
+            self.external_services.send_debt_to_user,
+            user_contact, payment_link, payment_items, template_values
+        )
+
+
+    async def get_paid_debts(self, full_scan: bool = False):
+        """Get the paid debts not read by previous runs, or every paid debt with full_scan."""
+        return await run_blocking(self.external_services.get_paid_debts, full_scan)
+
+
+    async def get_paid_debt(self, payment_id):
+        """Get the paid debt of a single payment, as notified by Mercado Pago."""
+        return await run_blocking(self.external_services.get_paid_debt, payment_id)
 
 
-    def get_paid_debts(self):
-        """Get the paid debts and remove then from json"""
-        return get_paid_debts()
+    async def save_payment_cursor(self):
+        """Save the position of the last paid debt read, after processing them."""
+        await run_blocking(self.external_services.save_payment_cursor)
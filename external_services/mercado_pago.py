@@ -1,16 +1,77 @@
 """Mercado Pago API integration for payment links."""
+import hashlib
+import json
 import os
-import sys
+import threading
 from datetime import datetime, timezone, timedelta
-from dotenv import load_dotenv
 import mercadopago
-from core import Debt
+from mercadopago.http.http_client import HttpClient
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from config.tenants import load_env
+from core import TAX_PERCENT, TAXES_LABEL, Bill, Debt, PaidDebt, apply_rate
 from logger import Logger
+from metrics import call_api, instrument_session
+from state_store import get_state_store
+
+PAYMENT_CURSOR_PATH = "state/mercado_pago_cursor.json"
+PAYMENTS_PAGE_SIZE = 100 # Payments requested per search page
+PREFERENCE_MIN_VALIDITY = timedelta(days=1) # Reused payment links must be valid for this long
+POOL_SIZE = 20 # Connections kept open to Mercado Pago
+# Server errors retried by the HTTP client. Throttled requests are retried by call_api
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+
+def get_items_hash(preference_items: list[dict]) -> str:
+    """Get a hash of the preference items, to detect when the debts changed."""
+    return hashlib.sha256(
+        json.dumps(preference_items, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+class PooledHttpClient(HttpClient):
+    """Mercado Pago HTTP client that keeps its connections open between requests.
+
+    The default client of the SDK opens a new session, and a new connection, on every call."""
+    def __init__(self, pool_size: int = POOL_SIZE, max_retries: int = 3):
+        self.session = requests.Session()
+        retry_strategy = Retry(total=max_retries, status_forcelist=RETRY_STATUS_CODES)
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=max(1, pool_size), max_retries=retry_strategy
+        )
+        self.session.mount("https://", adapter)
+        instrument_session(self.session)
+
+
+    def request(self, method, url, maxretries=None, **kwargs):  # pylint: disable=unused-argument
+        """Make a call to the API through the shared session. The retries are set on the pool."""
+        api_result = self.session.request(method, url, **kwargs)
+        response = {"status": api_result.status_code, "response": None}
+        if api_result.status_code != 204 and api_result.content:
+            try:
+                response["response"] = api_result.json()
+            except ValueError as e:
+                print(f"Failed to parse JSON: {str(e)}")
+        return response
+
+
+_http_client: PooledHttpClient = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client() -> PooledHttpClient:
+    """Get the Mercado Pago HTTP client shared by every call of the process."""
+    global _http_client  # pylint: disable=global-statement
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = PooledHttpClient(int(os.getenv("MERCADO_PAGO_POOL_SIZE", POOL_SIZE)))
+        return _http_client
 
 
 class PaymentData:
     """Class to process payment data."""
-    tax_percent: float = 0.0099
+    tax_percent: float = TAX_PERCENT
     user_debts: list[Debt] = None
     expiration_from: datetime = None
     expiration_to: datetime = None
@@ -18,33 +79,27 @@ class PaymentData:
 
     def __init__(self):
         self.total_value = 0.0  # Initialize total_value in __init__
+        self.total_cents = 0
+        self.debts_cents = 0
         self.json_filename = "payment_data.json"
 
 
     @property
     def settings(self):
         """Load Mercado Pago SDK settings."""
-        load_dotenv()
+        load_env()
         access_token = os.getenv("ACCESS_TOKEN")
         if not access_token:
             print("Mercado Pago ACCESS_TOKEN is missing. Please check your environment variables. "
                   "You can set it by adding 'ACCESS_TOKEN=<your_token>' to your .env file.")
-        sdk = mercadopago.SDK(access_token)
+        sdk = mercadopago.SDK(access_token, http_client=get_http_client())
         return sdk
 
 
     def get_debts(self, user_debts=None):
         """Get the debts with Debt type"""
-        if user_debts:
-            self.user_debts = [
-                Debt(
-                    label=debt.label,
-                    value=float(debt.value)  # Ensure value is a float
-                )
-                for debt in user_debts
-            ]
-        else:
-            self.user_debts = []
+        # Debts are immutable, so they are shared instead of copied
+        self.user_debts = list(user_debts) if user_debts else []
 
 
     def has_debts(self):
@@ -54,11 +109,21 @@ class PaymentData:
 
     def get_taxes(self):
         """Calculate taxes for the given user debts."""
-        # Calculate taxes
-        debts_sum = sum(abs(debt.value) for debt in self.user_debts)
-        taxes = round(debts_sum * self.tax_percent, 2)
-        self.total_value = debts_sum + taxes
-        self.user_debts.append(Debt("Taxas", taxes))
+        # Calculate taxes in cents
+        debts_sum = sum(abs(debt.cents) for debt in self.user_debts)
+        taxes = apply_rate(debts_sum, self.tax_percent)
+        self.debts_cents = debts_sum
+        self.total_cents = debts_sum + taxes
+        self.total_value = self.total_cents / 100
+        self.user_debts.append(Debt(TAXES_LABEL, taxes))
+
+
+    def get_bill(self, bill: Bill):
+        """Get the debts, taxes and total already computed by the billing matrix."""
+        self.user_debts = bill.items
+        self.debts_cents = bill.total_cents - bill.taxes_cents
+        self.total_cents = bill.total_cents
+        self.total_value = self.total_cents / 100
 
 
     def set_expiration(self):
@@ -85,15 +150,19 @@ class PaymentData:
             {
                 "title": debt.label,
                 "quantity": 1,
-                "unit_price": round(abs(debt.value), 2),
+                "unit_price": abs(debt.cents) / 100,
                 "currency_id": "BRL"
             }
             for debt in self.user_debts
         ]
 
 
-def create_payment_link(user_debts, user_id) -> tuple[str, list[Debt]]:
-    """Get the payment link for the given user_id."""
+def create_payment_link(user_debts, user_id, bill: Bill = None) -> tuple[str, list[Debt]]:
+    """Get the payment link for the given user_id.
+
+    With the bill of the user, the taxes and total of the billing matrix are used as they are."""
+    if bill is not None:
+        user_debts = list(bill.debts)
     if not user_debts or not isinstance(user_debts, list):
         print("User debts cannot be empty.")
         return None, None
@@ -106,13 +175,26 @@ def create_payment_link(user_debts, user_id) -> tuple[str, list[Debt]]:
         print("User has no debts.")
         return None, None
 
-    # Get the Mercado Pago SDK settings
-    sdk = payment_data.settings
-    payment_data.get_taxes()
+    if bill is not None:
+        payment_data.get_bill(bill)
+    else:
+        payment_data.get_taxes()
     payment_data.set_expiration()
     preference_items = payment_data.to_json()
     external_reference = payment_data.external_reference(user_id)
 
+    # Reuse the preference created for the same reference and items, if it didn't expire
+    items_hash = get_items_hash(preference_items)
+    store = get_state_store()
+    valid_until = datetime.now(timezone.utc) + PREFERENCE_MIN_VALIDITY
+    cached_preference = store.get_cached_preference(external_reference, items_hash, valid_until)
+    if cached_preference:
+        print(f"Reusing the payment link created at {cached_preference['created_at']}.")
+        return cached_preference["payment_link"], payment_data.user_debts
+
+    # Get the Mercado Pago SDK settings
+    sdk = payment_data.settings
+
     # Create preference data
     preference_data = {
         "items": preference_items,
@@ -132,7 +214,9 @@ def create_payment_link(user_debts, user_id) -> tuple[str, list[Debt]]:
     }
 
     try:
-        preference_response = sdk.preference().create(preference_data)
+        preference_response = call_api(
+            "mercado_pago", "preference.create", sdk.preference().create, preference_data
+        )
         if preference_response["status"] == 201:
             preference = preference_response["response"]
             payment_link = preference["init_point"]
@@ -143,11 +227,26 @@ def create_payment_link(user_debts, user_id) -> tuple[str, list[Debt]]:
                 external_ref=preference["external_reference"],
                 payment_link=payment_link,
                 total_value=payment_data.total_value,
+                expiration=payment_data.expiration_to.isoformat(),
+                debts_value=payment_data.debts_cents / 100
+            )
+            # Record the payment link in the state store and cache the preference
+            store.cache_preference(
+                external_reference=preference["external_reference"],
+                items_hash=items_hash,
+                payment_link=payment_link,
+                expiration=payment_data.expiration_to.isoformat()
+            )
+            store.record_payment_link(
+                user_id=user_id,
+                external_reference=preference["external_reference"],
+                payment_link=payment_link,
+                total_value=payment_data.total_value,
                 expiration=payment_data.expiration_to.isoformat()
             )
             return payment_link, payment_data.user_debts
 
-        # If the response is not 201, print the error and exit
+        # If the response is not 201, print the error
         print(
             f"Error creating payment link: {preference_response['response']}."
             f"Status: {preference_response.get('status')}, "
@@ -155,43 +254,167 @@ def create_payment_link(user_debts, user_id) -> tuple[str, list[Debt]]:
         )
         return None, None
     except KeyError as e:
-        print(f"An error occurred while creating the payment link: {e}")
-        sys.exit("Failed to create payment link.")
+        # Fail only this link, the batch and the pipeline keep going with the other users
+        print(f"An error occurred while creating the payment link: missing {e} in the response.")
+        return None, None
+
+
+class PaymentCursor:
+    """Position of the last payment read from Mercado Pago, persisted between runs."""
+    def __init__(self, file_path: str = PAYMENT_CURSOR_PATH):
+        self.file_path = file_path
+        self.last_updated: datetime = None
+        self.seen_ids: set = set()  # Payments already read at the last update time
+        self.load()
+
+
+    def load(self) -> None:
+        """Load the cursor from the file, if it exists."""
+        if not os.path.exists(self.file_path):
+            return
+        try:
+            with open(self.file_path, "r", encoding="utf-8") as f:
+                cursor = json.load(f)
+            self.last_updated = datetime.fromisoformat(cursor["last_updated"])
+            self.seen_ids = set(cursor["seen_ids"])
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+            print(f"Invalid payment cursor in {self.file_path}. Reading the whole period.")
+            self.last_updated, self.seen_ids = None, set()
+
+
+    def save(self) -> None:
+        """Save the cursor to the file."""
+        if self.last_updated is None:
+            return
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        temp_path = f"{self.file_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"last_updated": self.last_updated.isoformat(), "seen_ids": sorted(self.seen_ids)},
+                f
+            )
+        os.replace(temp_path, self.file_path)
+
+
+    def is_new(self, payment_id, last_updated: datetime) -> bool:
+        """Check if the payment wasn't read by a previous run."""
+        if self.last_updated is None or last_updated > self.last_updated:
+            return True
+        return last_updated == self.last_updated and payment_id not in self.seen_ids
 
 
-def get_paid_debts() -> list[int]:
-    """Verify the debts, remove from json and return the paid."""
+    def advance(self, payment_id, last_updated: datetime) -> None:
+        """Move the cursor to the given payment."""
+        if self.last_updated is None or last_updated > self.last_updated:
+            self.last_updated = last_updated
+            self.seen_ids = {payment_id}
+        elif last_updated == self.last_updated:
+            self.seen_ids.add(payment_id)
+
+
+def iter_payments(sdk, filters: dict, page_size: int = PAYMENTS_PAGE_SIZE):
+    """Yield every payment of a search, requesting one page at a time."""
+    offset = 0
+    while True:
+        search_result = call_api(
+            "mercado_pago", "payment.search", sdk.payment().search,
+            {**filters, "offset": offset, "limit": page_size}
+        )
+        if search_result.get("status") != 200:
+            print(f"Error searching payments: {search_result.get('response')}. "
+                  f"Status: {search_result.get('status')}")
+            return
+        response = search_result["response"]
+        results = response.get("results") or []
+        yield from results
+
+        # Stop on the last page
+        offset += len(results)
+        total = response.get("paging", {}).get("total", 0)
+        if not results or offset >= total:
+            return
+
+
+def to_paid_debt(payment: dict) -> PaidDebt:
+    """Get the paid debt of an approved payment, or None if it isn't approved or has no user."""
+    if payment.get("status") != "approved" or not payment.get("external_reference"):
+        return None
+    # Extract the user ID and reference from the approved payment
+    return PaidDebt(
+        user_id=int(payment["external_reference"].split("_")[0]),
+        external_reference=payment["external_reference"],
+        payment_id=payment.get("id"),
+        amount=float(payment.get("transaction_amount") or 0.0)
+    )
+
+
+def get_paid_debt(payment_id) -> PaidDebt:
+    """Get the paid debt of a single payment by ID, or None if it isn't an approved debt."""
+    sdk = PaymentData().settings
+    payment_result = call_api("mercado_pago", "payment.get", sdk.payment().get, payment_id)
+    if payment_result.get("status") != 200:
+        print(f"Error getting the payment {payment_id}: {payment_result.get('response')}. "
+              f"Status: {payment_result.get('status')}")
+        return None
+
+    paid_debt = to_paid_debt(payment_result["response"])
+    if paid_debt:
+        # Record the payment in the state store
+        get_state_store().record_payments([paid_debt])
+    return paid_debt
+
+
+def get_paid_debts(cursor: PaymentCursor = None, full_scan: bool = False) -> list[PaidDebt]:
+    """Get the approved payments of the current month that weren't read by the cursor.
+
+    With full_scan, every payment of the last 30 days is returned. The cursor is advanced
+    in memory, call cursor.save() once the payments are processed."""
     # Initialize the PaymentData instance
     payment_data = PaymentData()
     sdk = payment_data.settings
 
     # Today and 30 days ago
-    end_date = datetime.now()
-    start_date = end_date - timedelta(days=30)
-
-    # Format dates to ISO 8601 standard (e.g., "2025-09-10T00:00:00Z")
-    start_date_str = start_date.strftime("%Y-%m-%dT00:00:00Z")
-    end_date_str = end_date.strftime("%Y-%m-%dT23:59:59Z")
-
-    # Search for payments within the date range
-    search_result = sdk.payment().search({
+    now = datetime.now(timezone.utc)
+    current_month = datetime.now().strftime("%m_%y")
+    start_date = now - timedelta(days=30)
+
+    # Start from the cursor, if it is inside the period
+    read_new_only = cursor is not None and not full_scan
+    if read_new_only and cursor.last_updated and cursor.last_updated > start_date:
+        start_date_str = cursor.last_updated.isoformat(timespec="milliseconds")
+    else:
+        # Format dates to ISO 8601 standard (e.g., "2025-09-10T00:00:00Z")
+        start_date_str = start_date.strftime("%Y-%m-%dT00:00:00Z")
+    end_date_str = now.strftime("%Y-%m-%dT23:59:59Z")
+
+    # Search the approved payments updated within the date range, oldest first. Payments
+    # approved after their creation keep the creation date, so the cursor uses the update date
+    payments = iter_payments(sdk, {
+        "status": "approved",
+        "range": "date_last_updated",
+        "sort": "date_last_updated",
+        "criteria": "asc",
         "begin_date": start_date_str,
         "end_date": end_date_str
     })
 
-    # Filter the payments
-    filtered_payments = [
-        payment["external_reference"]
-        for payment in search_result["response"]["results"]
-        if (
-            datetime.fromisoformat(payment["date_created"]).month == datetime.now().month and
-            datetime.fromisoformat(payment["date_created"]).year == datetime.now().year and
-            payment["status"] == "approved" and
-            payment["external_reference"] is not None
-        )
-    ]
-
-    # Extract user IDs from the approved payments
-    user_ids = [int(ref.split("_")[0]) for ref in filtered_payments]
-
-    return user_ids
+    paid_debts = []
+    for payment in payments:
+        # Parse the dates once
+        last_updated = datetime.fromisoformat(payment["date_last_updated"])
+        if read_new_only and not cursor.is_new(payment["id"], last_updated):
+            continue
+        if cursor:
+            cursor.advance(payment["id"], last_updated)
+
+        # Filter the payments
+        date_created = datetime.fromisoformat(payment["date_created"])
+        if date_created.strftime("%m_%y") != current_month:
+            continue
+        paid_debt = to_paid_debt(payment)
+        if paid_debt:
+            paid_debts.append(paid_debt)
+
+    # Record the payments in the state store
+    get_state_store().record_payments(paid_debts)
+    return paid_debts
@@ -1,29 +1,114 @@
 """Module to send messages via WhatsApp API."""
 import os
-import sys
-from dotenv import load_dotenv
+import threading
+import time
 import requests
-from core import Debt, Contact, get_current_month
+from requests.adapters import HTTPAdapter
+from config.tenants import load_env
+from core import Debt, Contact, MessageResult, format_brl, get_current_month
 from logger import Logger
+from metrics import call_api, instrument_session
+from ratelimit import backoff_delay, parse_retry_after, rate_limiter
+from state_store import get_state_store
+
+GRAPH_API_URL = "https://graph.facebook.com/v19.0"
+DEFAULT_MAX_CONCURRENCY = 10 # Messages sent at the same time, WHATSAPP_MAX_CONCURRENCY on .env
+MAX_RETRIES = 4
+# Server errors retried by the client. Throttled requests are retried by call_api
+RETRY_STATUS_CODES = {500, 502, 503, 504}
+
+
+class WhatsAppClient:
+    """WhatsApp Cloud API transport with a pooled session, retries and bounded concurrency."""
+    def __init__(
+        self,
+        phone_number_id: str,
+        access_token: str,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        max_retries: int = MAX_RETRIES,
+        session: requests.Session = None
+    ):
+        self.url = f"{GRAPH_API_URL}/{phone_number_id}/messages"
+        self.max_retries = max_retries
+        self._semaphore = threading.BoundedSemaphore(max(1, max_concurrency))
+
+        # Keep the connections open between messages
+        self.session = session or requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, max_concurrency))
+        self.session.mount("https://", adapter)
+        instrument_session(self.session)
+        self.session.headers.update({
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        })
+
+
+    def send(self, payload: dict) -> MessageResult:
+        """Send a message payload, retrying server errors within the shared retry budget."""
+        attempt = 0
+        while True:
+            attempt += 1
+            response = None
+            try:
+                with self._semaphore:
+                    response = call_api(
+                        "whatsapp", "messages", self.session.post,
+                        self.url, json=payload, timeout=10
+                    )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = str(e)
+            else:
+                if response.status_code == 200:
+                    messages = response.json().get("messages") or [{}]
+                    return MessageResult(
+                        status="sent", status_code=200, attempts=attempt,
+                        message_id=messages[0].get("id", "")
+                    )
+                error = response.text
+                if response.status_code not in RETRY_STATUS_CODES:
+                    break
+
+            if attempt > self.max_retries or not rate_limiter.retry_budget.try_retry():
+                break
+            retry_after = response.headers.get("Retry-After") if response is not None else None
+            time.sleep(backoff_delay(attempt, parse_retry_after(retry_after)))
+
+        return MessageResult(
+            status="failed",
+            status_code=response.status_code if response is not None else None,
+            attempts=attempt,
+            error=error
+        )
+
+
+_client: WhatsAppClient = None
+_client_lock = threading.Lock()
+
+
+def get_whatsapp_client() -> WhatsAppClient:
+    """Get the WhatsApp client shared by every message of the process."""
+    global _client  # pylint: disable=global-statement
+    with _client_lock:
+        if _client is None:
+            phone_number_id, access_token = MessageData().env()
+            max_concurrency = int(os.getenv("WHATSAPP_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY))
+            _client = WhatsAppClient(phone_number_id, access_token, max_concurrency)
+        return _client
 
 
 class MessageData:
     """Process the data for sending messages via WhatsApp API."""
-    payment_items: list[Debt] = None
+    payment_items: tuple[Debt, ...] = ()
 
-    def __init__(self, payment_items: list[dict[str, float]] = None):
-        if payment_items:
-            self.payment_items = [
-                Debt(debt.label, float(debt.value))  # Ensure value is a float
-                for debt in payment_items
-            ]
-        else:
-            self.payment_items = []
+    def __init__(self, payment_items: list[Debt] = None):
+        # Debts are immutable, so they are shared instead of copied
+        self.payment_items = tuple(payment_items) if payment_items else ()
+        self.parameters: dict[str, str] = {}
 
 
     def env(self):
         """Load environment variables for WhatsApp API credentials."""
-        load_dotenv()
+        load_env()
         phone_number_id = os.getenv("WHATSAPP_PHONE_NUMBER_ID")
         access_token = os.getenv("WHATSAPP_ACCESS_TOKEN")
         if not phone_number_id or not access_token:
@@ -31,61 +116,49 @@ class MessageData:
         return phone_number_id, access_token
 
 
-    def get_total_value(self) -> float:
-        """Calculate the total value of the payment items."""
-        # Remove any existing "Total" entry
-        self.payment_items = [item for item in self.payment_items if item.label.lower() != "total"]
-        self.payment_items.append(Debt("Total", sum(float(item.value) for item in self.payment_items)))
-
-
-    def align_payment_values(self) -> None:
-        """Align the payment values"""
-        for item in self.payment_items:
-            item.value = f"{item.value:.2f}".replace(".", ",")
-
-
-        def get_spaces(value: str) -> str:
-            """Get the number of spaces needed to align the values."""
-            return " " * (len("0000,00") - len(value))
-
-
-        for item in self.payment_items:
-            item.value = f"{get_spaces(item.value)}{item.value}"
+    def get_total_value(self) -> int:
+        """Calculate the total value of the payment items, in cents."""
+        # Ignore any existing "Total" entry
+        return sum(item.cents for item in self.payment_items if item.label.lower() != "total")
 
 
-    def to_whatsapp_payload(self):
-        """Convert the payment items to a format suitable for WhatsApp API."""
-        self.get_total_value()
-        self.align_payment_values()
+    def to_whatsapp_payload(self) -> dict[str, str]:
+        """Convert the payment items to aligned values suitable for WhatsApp API."""
         parameters = {}
         for item in self.payment_items:
             label = item.label.split()[0].lower()
-            parameters[label] = item.value
+            if label != "total":
+                parameters.setdefault(label, format_brl(item.cents))
+        parameters["total"] = format_brl(self.get_total_value())
+        self.parameters = parameters
         return parameters
 
 
     def get_debt_value(self, label: str) -> str:
-        """Get the value of a specific debt item."""
-        for item in self.payment_items:
-            if item.label.lower().split()[0] == label.lower():
-                return item.value
-        return "   0,00"
+        """Get the aligned value of a specific debt item."""
+        return self.parameters.get(label.lower(), format_brl(0))
 
 
 def send_debt_to_user(
     user_contact: Contact,
     payment_link: str,
-    payment_items: list[Debt] = None
-) -> None:
-    """Send the payment link and items to the user via WhatsApp API."""
-    if not user_contact or not payment_link or not payment_items:
+    payment_items: list[Debt] = None,
+    template_values: dict[str, str] = None
+) -> MessageResult:
+    """Send the payment link and items to the user via WhatsApp API.
+
+    The template values computed by the billing matrix are used as they are, when given."""
+    if not user_contact or not payment_link or not (payment_items or template_values):
         print("User contact, payment link, and payment items must be provided.")
-        return
+        return MessageResult(status="failed", error="Missing contact, link or items.")
 
     message_data = MessageData(payment_items)
-    phone_number_id, access_token = message_data.env()
+    client = get_whatsapp_client()
     current_month = get_current_month()
-    message_data.to_whatsapp_payload()
+    if template_values:
+        message_data.parameters = dict(template_values)
+    else:
+        message_data.to_whatsapp_payload()
 
     content_link = ""
     if "pref_id=" in payment_link:
@@ -93,11 +166,6 @@ def send_debt_to_user(
     else:
         raise ValueError("The payment_link does not contain 'pref_id='.")
 
-    url = f"https://graph.facebook.com/v19.0/{phone_number_id}/messages"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
     payload = {
         "messaging_product": "whatsapp",
         "to": user_contact.phone_number,
@@ -129,8 +197,16 @@ def send_debt_to_user(
             ]
         }
     }
-    response = requests.post(url, json=payload, headers=headers, timeout=10)
-    if response.status_code == 200:
+    result = client.send(payload)
+
+    # Record the message in the state store
+    get_state_store().record_message(
+        user_id=user_contact.splitwise_id,
+        phone_number=user_contact.phone_number,
+        payment_link=payment_link,
+        status="sent" if result.sent else f"failed_{result.status_code}"
+    )
+    if result.sent:
         print(f"Message sent successfully to {user_contact.name}.")
         # Log the WhatsApp message
         Logger.log_whatsapp_message(
@@ -139,7 +215,6 @@ def send_debt_to_user(
             payment_link=payment_link
         )
     else:
-        print(f"Failed to send message. Status code: {response.status_code}, "
-              f"Response: {response.text}")
-        print(f"WhatsApp API error: {response.status_code} - {response.text}")
-        sys.exit(1)
+        print(f"Failed to send message to {user_contact.name} after {result.attempts} attempts. "
+              f"Status code: {result.status_code}, Response: {result.error}")
+    return result
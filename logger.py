@@ -2,65 +2,193 @@
 Manages application logs for the monthly expense tracking system.
 
 This module handles the storage of various application events (e.g., WhatsApp messages,
-payment link creations, Splitwise entries) into separate JSON files within the 'logs/' directory.
-It ensures safe append operations and consistent data fo0rmatting.
+payment link creations, Splitwise entries) into separate JSON Lines files within the 'logs/'
+directory. Each event is appended as one line under a file lock, so concurrent writers never
+rewrite or corrupt the history. The active files are rotated by month or size, and the
+legacy JSON array files are still loaded by the reader.
 """
 import os
+import glob
 import json
-from core import Contact
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from core import Contact, file_lock
 
 # Define the log directory paths
-PAYMENT_LINK_LOG_PATH = "logs/payment_links.json" # Mercado Pago Payment Links
-EXPENSES_LOG_PATH = "logs/expenses.json"          # Splitwise Entries
-WHATSAPP_LOG_PATH = "logs/whatsapp_messages.json" # WhatsApp Messages
+PAYMENT_LINK_LOG_PATH = "logs/payment_links.jsonl" # Mercado Pago Payment Links
+EXPENSES_LOG_PATH = "logs/expenses.jsonl"          # Splitwise Entries
+WHATSAPP_LOG_PATH = "logs/whatsapp_messages.jsonl" # WhatsApp Messages
+
+# Rotate the active log file when the month changes or when it gets too big
+MAX_LOG_BYTES = 10 * 1024 * 1024
+
+# Entries kept in memory by Logger.buffered() before being written
+DEFAULT_FLUSH_SIZE = 50
+
+_BUFFER_LOCK = threading.Lock()
+
+
+def legacy_log_path(log_path: str) -> str:
+    """Get the path of the legacy JSON array file of a log."""
+    return os.path.splitext(log_path)[0] + ".json"
+
+
+def rotated_log_paths(log_path: str) -> list[str]:
+    """Get the rotated files of a log, from the oldest to the newest."""
+    base = os.path.splitext(log_path)[0]
+    return sorted(
+        glob.glob(f"{base}.*.jsonl"),
+        key=lambda path: [
+            int(part) for part in path[len(base) + 1:-len(".jsonl")].replace("-", ".").split(".")
+        ]
+    )
+
+
+def read_log(log_path: str) -> list[dict]:
+    """Read every entry of a log: legacy JSON array, rotated files and the active file."""
+    entries = []
+
+    # Load the legacy JSON array file if it still exists
+    legacy_path = legacy_log_path(log_path)
+    if os.path.exists(legacy_path):
+        with open(legacy_path, 'r', encoding='utf-8') as f:
+            try:
+                entries.extend(json.load(f))
+            except json.JSONDecodeError:
+                print(f"Skipping invalid legacy log file {legacy_path}.")
+
+    # Load the JSON Lines files, skipping a line cut by a crash
+    for path in [*rotated_log_paths(log_path), log_path]:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print(f"Skipping invalid log line in {path}.")
+    return entries
+
 
 class Logger:
     """Logger class to handle logging of various application events."""
+    _buffers: dict[str, list[dict]] = None
+    _flush_size: int = DEFAULT_FLUSH_SIZE
 
     def __init__(self):
         """Initialize the Logger and ensure log directories exist."""
         os.makedirs("logs", exist_ok=True)
-        self._initialize_log_files()
 
-    def _initialize_log_files(self):
-        """Create log files if they do not exist."""
-        for path in [PAYMENT_LINK_LOG_PATH, EXPENSES_LOG_PATH, WHATSAPP_LOG_PATH]:
-            if not os.path.exists(path):
-                with open(path, 'w', encoding='utf-8') as f:
-                    json.dump([], f)
+
+    @staticmethod
+    def _rotate_if_needed(log_path: str) -> None:
+        """Move the active log file aside when the month changed or it is too big."""
+        if not os.path.exists(log_path):
+            return
+        stat = os.stat(log_path)
+        file_month = datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m")
+        if file_month == datetime.now().strftime("%Y-%m") and stat.st_size < MAX_LOG_BYTES:
+            return
+
+        # Name the rotated file by its month, adding a counter on size rotations
+        base = os.path.splitext(log_path)[0]
+        rotated_path = f"{base}.{file_month}.jsonl"
+        counter = 1
+        while os.path.exists(rotated_path):
+            rotated_path = f"{base}.{file_month}.{counter}.jsonl"
+            counter += 1
+        os.replace(log_path, rotated_path)
 
 
     @staticmethod
-    def _append_to_log(log_path: str, log_entry: dict) -> None:
-        """Append a log entry to the specified log file."""
+    def _write_entries(log_path: str, log_entries: list[dict]) -> None:
+        """Append the log entries to the specified log file as JSON Lines."""
+        if not log_entries:
+            return
         # Verify if the folder exists, if not create it
         os.makedirs(os.path.dirname(log_path), exist_ok=True)
 
-        # Verify if the log file exists and append the entry
-        if not os.path.exists(log_path):
-            with open(log_path, 'w', encoding='utf-8') as f:
-                json.dump([], f)  # Create an empty list if file does not exist
+        lines = "".join(
+            json.dumps(log_entry, ensure_ascii=False) + "\n"
+            for log_entry in log_entries
+        )
+        # Lock the log so concurrent writers never interleave or rotate under each other
+        with file_lock(log_path):
+            Logger._rotate_if_needed(log_path)
+            with open(log_path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+
 
-        # Append the log entry
-        with open(log_path, 'r+', encoding='utf-8') as f:
-            logs = json.load(f)
-            logs.append(log_entry)
-            f.seek(0)
-            f.truncate()  # Clear the file content
-            json.dump(logs, f, indent=4, ensure_ascii=False)
+    @staticmethod
+    def _append_to_log(log_path: str, log_entry: dict, buffered: bool = True) -> None:
+        """Append a log entry to the specified log file."""
+        log_entry = {"logged_at": datetime.now().isoformat(), **log_entry}
+
+        with _BUFFER_LOCK:
+            # Keep the entry in memory while a buffered block is running
+            if buffered and Logger._buffers is not None:
+                buffer = Logger._buffers.setdefault(log_path, [])
+                buffer.append(log_entry)
+                if len(buffer) < Logger._flush_size:
+                    return
+                Logger._buffers[log_path] = []
+                log_entries = buffer
+            else:
+                log_entries = [log_entry]
+        Logger._write_entries(log_path, log_entries)
 
 
     @staticmethod
-    def log_payment_link(user_id, external_ref, payment_link: str, total_value, expiration) -> None:
+    def flush() -> None:
+        """Write every buffered entry to its log file."""
+        with _BUFFER_LOCK:
+            if not Logger._buffers:
+                return
+            buffers = Logger._buffers
+            Logger._buffers = {}
+        for log_path, log_entries in buffers.items():
+            Logger._write_entries(log_path, log_entries)
+
+
+    @staticmethod
+    @contextmanager
+    def buffered(flush_size: int = DEFAULT_FLUSH_SIZE):
+        """Buffer the log entries and write them in batches until the block ends.
+
+        The payment links are always written right away, since a crash would lose them."""
+        with _BUFFER_LOCK:
+            Logger._buffers = {}
+            Logger._flush_size = flush_size
+        try:
+            yield
+        finally:
+            with _BUFFER_LOCK:
+                buffers = Logger._buffers or {}
+                Logger._buffers = None
+                Logger._flush_size = DEFAULT_FLUSH_SIZE
+            for log_path, log_entries in buffers.items():
+                Logger._write_entries(log_path, log_entries)
+
+
+    @staticmethod
+    def log_payment_link(
+        user_id, external_ref, payment_link: str, total_value, expiration, debts_value=None
+    ) -> None:
         """Log the creation of a payment link for a user."""
         log_entry = {
             "user_id": user_id,
             "external_ref": external_ref,
             "payment_link": payment_link,
             "total_value": total_value,
+            "debts_value": debts_value, # Total without taxes, settled on Splitwise
             "expiration": expiration
         }
-        Logger._append_to_log(PAYMENT_LINK_LOG_PATH, log_entry)
+        # Never buffered: the reconciliation reads the links from this log, and the month close
+        # checkpoints the link right after, so a resumed run never logs it again
+        Logger._append_to_log(PAYMENT_LINK_LOG_PATH, log_entry, buffered=False)
 
 
     @staticmethod
@@ -1,15 +1,61 @@
-"""Splitwise API Python Client"""
+"""Splitwise API Python Client
+
+The services are imported inside each command, so a command only pays the import cost of
+the APIs it uses (e.g. `get-users` never loads the Mercado Pago and WhatsApp stacks).
+"""
+# pylint: disable=import-outside-toplevel
+import json
+import os
 import typer # type: ignore
-from data_access import DataAccess
-from external_services import ExternalServices
-from cli import show_all_users, show_user_debts, show_payment_link, show_created_payment
+from batch import DEFAULT_WORKERS
+from cli import (
+    show_all_users, show_user_debts, show_payment_link, show_created_payment, show_send_results,
+    show_month_status, show_import_report, show_reconciliations, show_tenant_results
+)
+from metrics import metrics
 
 app = typer.Typer()
 
 
+def report_metrics() -> None:
+    """Export the API metrics of the command and print their summary."""
+    if not metrics.calls:
+        return
+    metrics.write_textfile()
+    print(json.dumps({"api_metrics": metrics.summary()}, indent=4, ensure_ascii=False))
+
+
+@app.callback()
+def setup(
+    ctx: typer.Context,
+    no_cache: bool = typer.Option(
+        False, "--no-cache", help="Read the friends and expenses from Splitwise, not the cache."),
+    tenant: str = typer.Option(
+        None, "--tenant", "-t", help="Run with the profile of a tenant in config/tenants.json.")
+) -> None:
+    """Automate the payments made at the Fábrica with Splitwise, Mercado Pago and WhatsApp."""
+    # Run in the tenant directory, before any file or credential is read
+    if tenant:
+        from config.tenants import get_tenant, use_tenant
+        try:
+            use_tenant(get_tenant(tenant))
+        except ValueError as e:
+            print(e)
+            raise typer.Exit(code=1)
+
+    # Report the API metrics when the command ends, even if it fails
+    ctx.call_on_close(report_metrics)
+
+    # Read by the Splitwise cache, imported only by the commands that use it
+    if no_cache:
+        os.environ["SPLITWISE_NO_CACHE"] = "1"
+
+
 @app.command()
 def get_users() -> None:
     """Get all users from Splitwise API"""
+    from data_access import DataAccess
+
     # Initialize the Data Access Layer
     data_access = DataAccess()
 
@@ -20,10 +66,11 @@ def get_users() -> None:
     show_all_users(users)
 
 
-
 @app.command()
 def get_user_debts(user_id: int) -> None:
     """Get user debts from the last month by ID."""
+    from data_access import DataAccess
+
     # Initialize the Data Access Layer
     data_access = DataAccess()
 
@@ -37,13 +84,16 @@ def get_user_debts(user_id: int) -> None:
 @app.command()
 def create_payment_link(user_id: int,) -> None:
     """Get the payment link for the given user_id."""
+    from data_access import DataAccess
+    from external_services import ExternalServices
+
     # Initialize the Data Access Layer
     data_access = DataAccess()
     external_services = ExternalServices()
 
     # Create payment link
-    user_debts = data_access.get_user_debts(user_id)
-    payment_link, payment_items = external_services.create_payment_link(user_debts, user_id)
+    bill = data_access.get_billing_matrix([user_id]).bill(user_id)
+    payment_link, payment_items = external_services.create_payment_link(None, user_id, bill)
 
     # Show payment link in the CLI
     show_payment_link(payment_link, payment_items)
@@ -52,20 +102,170 @@ def create_payment_link(user_id: int,) -> None:
 @app.command()
 def send_payment_link(user_id: int) -> None:
     """Get user debts and payment link, then send them to the user."""
+    from data_access import DataAccess
+    from external_services import ExternalServices
+
     # Initialize the Data Access Layer
     data_access = DataAccess()
     external_services = ExternalServices()
 
     # Create payment link
-    user_debts = data_access.get_user_debts(user_id)
-    payment_link, payment_items = external_services.create_payment_link(user_debts, user_id)
+    bill = data_access.get_billing_matrix([user_id]).bill(user_id)
+    payment_link, payment_items = external_services.create_payment_link(None, user_id, bill)
 
     # Send to the user
     user_contact = data_access.get_user_contact(user_id)
-    external_services.send_debt_to_user(user_contact, payment_link, payment_items)
+    message_result = external_services.send_debt_to_user(
+        user_contact, payment_link, payment_items, bill.template_values if bill else None
+    )
 
     # Show payment link in the CLI
     show_payment_link(payment_link, payment_items)
+    if not message_result.sent:
+        raise typer.Exit(code=1)
+
+
+@app.command()
+def send_payment_links(
+    user_ids: list[int] = typer.Argument(None, help="IDs of the users to send the links."),
+    all_users: bool = typer.Option(
+        False, "--all", "-a", help="Send the payment links to every Splitwise friend."),
+    workers: int = typer.Option(
+        DEFAULT_WORKERS, "--workers", "-w", help="Number of users processed at the same time.")
+) -> None:
+    """Send the payment links to many users at once."""
+    from data_access import DataAccess
+    from external_services import ExternalServices
+    from batch import send_payment_links as send_payment_links_batch
+    from logger import Logger
+
+    if not user_ids and not all_users:
+        print("Provide the users IDs or use --all to send to every user.")
+        raise typer.Exit(code=1)
+
+    # Initialize the Data Access Layer and External Services once for every user
+    data_access = DataAccess()
+    external_services = ExternalServices()
+
+    # Get every user from Splitwise API if requested
+    if all_users:
+        user_ids = [user["id"] for user in data_access.get_all_users()]
+
+    # Send the payment links to the users, writing the logs in batches
+    with Logger.buffered():
+        results = send_payment_links_batch(data_access, external_services, user_ids, workers)
+
+    # Show the result of each user in the CLI
+    show_send_results(results)
+
+
+@app.command()
+def month_close(
+    user_ids: list[int] = typer.Argument(None, help="IDs of the users to close the month."),
+    all_users: bool = typer.Option(
+        False, "--all", "-a", help="Close the month of every Splitwise friend."),
+    workers: int = typer.Option(
+        None, "--workers", "-w",
+        help=f"Number of users processed by each stage. Defaults to {DEFAULT_WORKERS}, "
+             "or 100 with --async."),
+    queue_size: int = typer.Option(
+        100, "--queue-size", help="Number of users waiting between two stages."),
+    use_async: bool = typer.Option(
+        False, "--async",
+        help="Schedule the stages as coroutines, keeping more users in flight. The clients "
+             "still block, on a shared thread pool.")
+) -> None:
+    """Send the payment links and settle the paid debts, resuming an interrupted run."""
+    from data_access import DataAccess
+    from external_services import ExternalServices
+    from pipeline import MonthClosePipeline
+    from logger import Logger
+
+    if not user_ids and not all_users:
+        print("Provide the users IDs or use --all to close the month of every user.")
+        raise typer.Exit(code=1)
+    if use_async:
+        month_close_async(user_ids, all_users, workers, queue_size)
+        return
+    workers = workers or DEFAULT_WORKERS
+
+    # Initialize the Data Access Layer and External Services once for every user
+    data_access = DataAccess()
+    external_services = ExternalServices()
+
+    # Get every user from Splitwise API if requested
+    if all_users:
+        user_ids = [user["id"] for user in data_access.get_all_users()]
+
+    # Run the stages, writing the logs in batches
+    pipeline = MonthClosePipeline(data_access, external_services, workers, queue_size)
+    with Logger.buffered():
+        results = pipeline.run(user_ids)
+    show_send_results(results)
+
+    # Settle the payments approved so far
+    show_reconciliations(pipeline.settle())
+
+
+def month_close_async(
+    user_ids: list[int], all_users: bool, workers: int = None, queue_size: int = 100
+) -> None:
+    """Run the month close on an event loop, over the async facades."""
+    import asyncio
+    from aio import MAX_IN_FLIGHT, shutdown_executor
+    from data_access import AsyncDataAccess
+    from external_services import AsyncExternalServices
+    from pipeline import AsyncMonthClosePipeline
+    from logger import Logger
+
+    async def close_month():
+        data_access = AsyncDataAccess()
+        external_services = AsyncExternalServices()
+        ids = user_ids
+        if all_users:
+            ids = [user["id"] for user in await data_access.get_all_users()]
+
+        pipeline = AsyncMonthClosePipeline(
+            data_access, external_services, workers or MAX_IN_FLIGHT // 2, queue_size
+        )
+        with Logger.buffered():
+            results = await pipeline.run(ids)
+        show_send_results(results)
+        show_reconciliations(await pipeline.settle())
+
+    try:
+        asyncio.run(close_month())
+    finally:
+        shutdown_executor()
+
+
+@app.command()
+def month_close_all(
+    tenant_names: list[str] = typer.Argument(
+        None, help="Names of the tenants to close the month. Every tenant by default."),
+    processes: int = typer.Option(
+        4, "--processes", "-p", help="Number of tenants closed at the same time."),
+    workers: int = typer.Option(
+        DEFAULT_WORKERS, "--workers", "-w", help="Number of users processed by each stage."),
+    queue_size: int = typer.Option(
+        100, "--queue-size", help="Number of users waiting between two stages.")
+) -> None:
+    """Run the month close of every tenant, each one in its own worker process."""
+    from config.tenants import load_tenants
+    from tenant_runner import close_tenants_month
+
+    try:
+        tenants = load_tenants()
+    except ValueError as e:
+        print(e)
+        raise typer.Exit(code=1)
+    unknown = [name for name in tenant_names or [] if name not in tenants]
+    if unknown:
+        print(f"Tenants not found in config/tenants.json: {', '.join(unknown)}.")
+        raise typer.Exit(code=1)
+
+    selected = [tenants[name] for name in tenant_names] if tenant_names else list(tenants.values())
+    show_tenant_results(close_tenants_month(selected, processes, workers, queue_size))
 
 
 @app.command()
@@ -74,32 +274,118 @@ def create_user_debts(
         "data_access/src/debts.csv", "--path", "-p", help="Path to the CSV file with user debts."),
     description: str = typer.Option(
         ..., "--description", "-d", help="Description of the expense."
-    )
+    ),
+    workers: int = typer.Option(
+        DEFAULT_WORKERS, "--workers", "-w", help="Number of expenses created at the same time.")
 ) -> None:
     """Create user debts with Splitwise API."""
+    from data_access import DataAccess
+
     # Initialize the Data Access Layer
     data_access = DataAccess()
 
+    # Read the CSV file and show the rows that could not be imported
+    debts, report = data_access.get_debts_from_csv(csv_path=path)
+    show_import_report(report)
+
     # Create user debts with Splitwise
-    debts = data_access.get_debts_from_csv(csv_path=path)
-    expenses, description = data_access.create_user_debts(path, description, debts)
+    expenses, description = data_access.create_user_debts(path, description, debts, workers)
 
     # Show created payment in the CLI
     show_created_payment(expenses, description)
 
 
 @app.command()
-def get_paid_debts():
+def get_paid_debts(
+    full_scan: bool = typer.Option(
+        False, "--full", help="Read every payment of the last 30 days, not only the new ones.")
+):
     """Verify the paid users and send to Splitwise"""
+    from data_access import DataAccess
+    from reconciliation import get_settlements, reconcile, with_unsettled_payments
+    from external_services import ExternalServices
+
     # Initialize the External Services and Data Access Layer
     external_services = ExternalServices()
     data_access = DataAccess()
 
-    # Get paid users from external services
-    paid_users = external_services.get_paid_debts()
+    # Get paid debts from external services, retrying the ones never settled
+    paid_debts = with_unsettled_payments(external_services.get_paid_debts(full_scan))
+
+    # Match the payments with the payment links
+    reconciliations = reconcile(paid_debts)
+    show_reconciliations(reconciliations)
+
+    # Send the reconciled payments to Splitwise API
+    data_access.send_payments(get_settlements(reconciliations))
+
+    # The payments not settled stay unsettled in the state store and are retried next run
+    external_services.save_payment_cursor()
+
+
+@app.command()
+def month_status(
+    month: str = typer.Option(
+        None, "--month", "-m", help="Month in the format MM_YY. Defaults to the current month.")
+) -> None:
+    """Show who has a payment link, a message, a payment and a settlement, from local state."""
+    from state_store import get_state_store, get_month_key
+
+    month = month or get_month_key()
+
+    # Get the status from the local state store, without calling the APIs
+    users_status = get_state_store().get_month_status(month)
+
+    # Show the status of each user in the CLI
+    show_month_status(month, users_status)
+
+
+@app.command()
+def serve_webhook(
+    host: str = typer.Option("127.0.0.1", "--host", help="Address to listen on."),
+    port: int = typer.Option(8080, "--port", "-p", help="Port to listen on."),
+    workers: int = typer.Option(
+        2, "--workers", "-w", help="Number of payments settled at the same time.")
+) -> None:
+    """Settle the payments as soon as Mercado Pago notifies them."""
+    import time
+    from data_access import DataAccess
+    from external_services import ExternalServices
+    from webhook import WebhookServer
+
+    # Initialize the Data Access Layer and External Services once for every notification
+    data_access = DataAccess()
+    external_services = ExternalServices()
+
+    # Serve until interrupted, then finish the queued settlements
+    server = WebhookServer(data_access, external_services, host, port, workers)
+    server.start()
+    print(f"Listening for Mercado Pago notifications on {server.url}. Press Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Stopping, waiting for the queued settlements.")
+    finally:
+        server.stop()
+
+
+@app.command()
+def simulate_webhook(
+    payment_id: int = typer.Argument(..., help="ID of the notified Mercado Pago payment."),
+    url: str = typer.Option(
+        "http://127.0.0.1:8080/webhooks/mercado-pago", "--url", "-u", help="URL of the webhook.")
+) -> None:
+    """Send a payment notification to a local webhook, like Mercado Pago does."""
+    from config.tenants import load_env
+    from webhook import WEBHOOK_SECRET_ENV, send_notification
 
-    # Send payments to Splitwise API
-    data_access.send_payments(paid_users)
+    # Sign the notification with the secret of the .env, like the webhook checks it
+    load_env()
+    response = send_notification(url, payment_id, os.getenv(WEBHOOK_SECRET_ENV))
+    print(f"Notification of the payment {payment_id} answered with status {response.status_code}.")
+    if response.status_code != 200:
+        raise typer.Exit(code=1)
 
 if __name__ == "__main__":
     app()
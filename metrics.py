@@ -0,0 +1,254 @@
+"""
+Metrics of the calls made to the external APIs.
+
+Every outbound call to Splitwise, Mercado Pago and WhatsApp goes through `call_api`, which
+applies the shared rate limits of `ratelimit` and records the call count, a latency
+histogram and the errors by status of each endpoint. The metrics are exported as a
+Prometheus textfile and as a JSON summary.
+
+The bytes sent and received are measured at the HTTP layer, by a response hook on the
+sessions of the Mercado Pago and WhatsApp clients (`instrument_session`). The Splitwise SDK
+opens a private session on every request, so its endpoints have no byte metrics instead of
+a misleading zero.
+"""
+import contextvars
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from ratelimit import MAX_THROTTLE_RETRIES, backoff_delay, get_throttle_delay, rate_limiter
+
+METRICS_TEXTFILE_PATH = "logs/metrics.prom"
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+# Service and endpoint of the call running in the current thread, read by the session hook
+_current_call = contextvars.ContextVar("current_call", default=None)
+
+
+def get_status(result) -> str:
+    """Get the status of an API result: HTTP status, SDK status or "ok"."""
+    # Mercado Pago SDK responses
+    if isinstance(result, dict) and "status" in result:
+        return str(result["status"])
+    # requests responses
+    status_code = getattr(result, "status_code", None)
+    if status_code is not None:
+        return str(status_code)
+    # Splitwise createExpense returns (None, errors) when the expense is rejected
+    if isinstance(result, tuple) and len(result) == 2 and result[0] is None:
+        return "rejected"
+    return "ok"
+
+
+def is_error_status(status: str) -> bool:
+    """Check if a status is an error."""
+    if status.isdigit():
+        return int(status) >= 400
+    return status != "ok"
+
+
+class Metrics:
+    """Thread-safe registry of the API call metrics."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = Counter()
+        self.errors = Counter()
+        self.bytes_sent = Counter()
+        self.bytes_received = Counter()
+        self.latency_sum = defaultdict(float)
+        self.latency_max = defaultdict(float)
+        self.latency_buckets = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+
+
+    def record(self, service: str, endpoint: str, seconds: float, status: str):
+        """Record one call to an endpoint."""
+        key = (service, endpoint)
+        with self._lock:
+            self.calls[key] += 1
+            self.latency_sum[key] += seconds
+            self.latency_max[key] = max(self.latency_max[key], seconds)
+            buckets = self.latency_buckets[key]
+            for i, upper_bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= upper_bound:
+                    buckets[i] += 1
+                    break
+            if is_error_status(status):
+                self.errors[(service, endpoint, status)] += 1
+
+
+    def record_transfer(self, service: str, endpoint: str, sent: int, received: int) -> None:
+        """Record the bytes of one HTTP exchange of an endpoint."""
+        key = (service, endpoint)
+        with self._lock:
+            self.bytes_sent[key] += sent
+            self.bytes_received[key] += received
+
+
+    def summary(self) -> dict:
+        """Get the metrics of each endpoint as a dictionary."""
+        with self._lock:
+            summary = {}
+            for (service, endpoint), calls in sorted(self.calls.items()):
+                key = (service, endpoint)
+                summary[f"{service}.{endpoint}"] = {
+                    "calls": calls,
+                    "errors": {
+                        status: count
+                        for (error_service, error_endpoint, status), count in self.errors.items()
+                        if (error_service, error_endpoint) == key
+                    },
+                    "latency_avg_ms": round(self.latency_sum[key] / calls * 1000, 1),
+                    "latency_max_ms": round(self.latency_max[key] * 1000, 1),
+                }
+                # Only the endpoints measured at the HTTP layer have bytes
+                if key in self.bytes_received:
+                    summary[f"{service}.{endpoint}"].update({
+                        "bytes_sent": self.bytes_sent[key],
+                        "bytes_received": self.bytes_received[key],
+                    })
+            return summary
+
+
+    def to_prometheus(self) -> str:
+        """Get the metrics in the Prometheus text exposition format."""
+        lines = [
+            "# HELP payment_control_api_calls_total Calls made to the external APIs.",
+            "# TYPE payment_control_api_calls_total counter",
+        ]
+        with self._lock:
+            keys = sorted(self.calls)
+            for service, endpoint in keys:
+                labels = f'service="{service}",endpoint="{endpoint}"'
+                lines.append(
+                    f"payment_control_api_calls_total{{{labels}}} {self.calls[(service, endpoint)]}"
+                )
+
+            lines += [
+                "# HELP payment_control_api_errors_total Failed calls to the external APIs.",
+                "# TYPE payment_control_api_errors_total counter",
+            ]
+            for (service, endpoint, status), count in sorted(self.errors.items()):
+                labels = f'service="{service}",endpoint="{endpoint}",status="{status}"'
+                lines.append(f"payment_control_api_errors_total{{{labels}}} {count}")
+
+            lines += [
+                "# HELP payment_control_api_request_bytes_total Bytes sent to the APIs.",
+                "# TYPE payment_control_api_request_bytes_total counter",
+            ]
+            for service, endpoint in sorted(self.bytes_sent):
+                labels = f'service="{service}",endpoint="{endpoint}"'
+                lines.append(
+                    f"payment_control_api_request_bytes_total{{{labels}}} "
+                    f"{self.bytes_sent[(service, endpoint)]}"
+                )
+
+            lines += [
+                "# HELP payment_control_api_response_bytes_total Bytes received from the APIs.",
+                "# TYPE payment_control_api_response_bytes_total counter",
+            ]
+            for service, endpoint in sorted(self.bytes_received):
+                labels = f'service="{service}",endpoint="{endpoint}"'
+                lines.append(
+                    f"payment_control_api_response_bytes_total{{{labels}}} "
+                    f"{self.bytes_received[(service, endpoint)]}"
+                )
+
+            lines += [
+                "# HELP payment_control_api_latency_seconds Latency of the API calls.",
+                "# TYPE payment_control_api_latency_seconds histogram",
+            ]
+            for service, endpoint in keys:
+                key = (service, endpoint)
+                labels = f'service="{service}",endpoint="{endpoint}"'
+                cumulative = 0
+                for upper_bound, count in zip(LATENCY_BUCKETS, self.latency_buckets[key]):
+                    cumulative += count
+                    bound = "+Inf" if upper_bound == float("inf") else str(upper_bound)
+                    lines.append(
+                        f'payment_control_api_latency_seconds_bucket{{{labels},le="{bound}"}} '
+                        f"{cumulative}"
+                    )
+                lines.append(
+                    f"payment_control_api_latency_seconds_sum{{{labels}}} "
+                    f"{self.latency_sum[key]:.6f}"
+                )
+                lines.append(
+                    f"payment_control_api_latency_seconds_count{{{labels}}} {self.calls[key]}"
+                )
+        return "\n".join(lines) + "\n"
+
+
+    def write_textfile(self, path: str = METRICS_TEXTFILE_PATH) -> None:
+        """Write the metrics to a Prometheus textfile."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first so the collector never reads a partial file
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(temp_path, path)
+
+
+    def reset(self) -> None:
+        """Remove every recorded metric."""
+        self.__init__()  # pylint: disable=unnecessary-dunder-call
+
+
+metrics = Metrics()
+
+
+def record_transfer_hook(response, *args, **kwargs):  # pylint: disable=unused-argument
+    """requests response hook: record the bytes of the exchange in the current call."""
+    call = _current_call.get()
+    if call is None:
+        return
+    body = response.request.body if response.request is not None else None
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    metrics.record_transfer(*call, len(body or b""), len(response.content or b""))
+
+
+def instrument_session(session) -> None:
+    """Measure the bytes sent and received through a requests session."""
+    session.hooks["response"].append(record_transfer_hook)
+
+
+def call_api(service: str, endpoint: str, function, *args, **kwargs):
+    """Call an external API function within the service rate limits and record its metrics.
+
+    Throttled calls are retried while the shared retry budget allows."""
+    limiter = rate_limiter.get(service)
+    rate_limiter.retry_budget.record_request()
+    attempt = 0
+    while True:
+        attempt += 1
+        with limiter.slot():
+            start = time.perf_counter()
+            token = _current_call.set((service, endpoint))
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                metrics.record(service, endpoint, time.perf_counter() - start, type(e).__name__)
+                retry_after = get_throttle_delay(service, e)
+                if retry_after is None:
+                    raise
+                limiter.on_throttle(retry_after)
+                if attempt > MAX_THROTTLE_RETRIES or not rate_limiter.retry_budget.try_retry():
+                    raise
+            else:
+                metrics.record(service, endpoint, time.perf_counter() - start, get_status(result))
+                retry_after = get_throttle_delay(service, result)
+                if retry_after is None:
+                    limiter.on_success()
+                    return result
+                limiter.on_throttle(retry_after)
+                if attempt > MAX_THROTTLE_RETRIES or not rate_limiter.retry_budget.try_retry():
+                    return result
+            finally:
+                _current_call.reset(token)
+
+        # Wait outside of the request slot
+        time.sleep(backoff_delay(attempt, retry_after))
@@ -0,0 +1,333 @@
+"""
+Resumable month close pipeline.
+
+The members flow through explicit stages connected by bounded queues: the payment link of
+each bill is created, then the WhatsApp message is sent. The last stage completed by each
+member is checkpointed in the state store, so an interrupted run resumes where it stopped
+without creating the same link or sending the same message again. At the end, the approved
+payments are reconciled with the links and settled on Splitwise, which is idempotent by
+external reference.
+
+`AsyncMonthClosePipeline` is a thin shim that schedules the same stages as coroutines over
+the async facades. The facades still run the blocking clients on the thread pool of `aio`,
+so it only differs by keeping more members in flight than the stage threads would.
+"""
+import asyncio
+import queue
+import threading
+from aio import MAX_IN_FLIGHT, run_blocking
+from batch import (
+    DEFAULT_WORKERS, check_bill, check_billing_matrix, check_contact, check_payment_link,
+    get_message_result
+)
+from core import Bill, Contact, Reconciliation, SendResult
+from reconciliation import get_settlements, reconcile, with_unsettled_payments
+from state_store import get_month_key, get_state_store
+
+# Members waiting between two stages
+QUEUE_SIZE = 100
+
+# Stages checkpointed for each member
+LINKED = "linked"
+SENT = "sent"
+# Saved by earlier versions for members without debts, who are now billed again on every run
+NO_DEBTS = "no_debts"
+
+_DONE = object() # Tells a stage worker there are no more members
+
+
+def get_resumable_checkpoints(checkpoints: dict[int, dict]) -> dict[int, dict]:
+    """Get the checkpoints a run resumes from, without the members that had no debts."""
+    return {
+        user_id: checkpoint
+        for user_id, checkpoint in checkpoints.items() if checkpoint["stage"] != NO_DEBTS
+    }
+
+
+class MonthCloseStages:
+    """Stages of the month close shared by the pipelines, which only differ by scheduling."""
+    def __init__(self, data_access, external_services, workers: int, queue_size: int):
+        self.data_access = data_access
+        self.external_services = external_services
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.month = get_month_key()
+        self.store = get_state_store()
+        self.link_queue = None
+        self.message_queue = None
+        self.results: dict[int, SendResult] = {}
+
+
+    def _set_result(self, result: SendResult) -> None:
+        """Keep the result of a member."""
+        self.results[result.user_id] = result
+
+
+    def _set_failure(self, user_id: int, error: BaseException) -> None:
+        """Keep the result of a member whose stage raised."""
+        self._set_result(
+            SendResult(user_id=user_id, status="failed", error=str(error) or type(error).__name__)
+        )
+
+
+    def _route(
+        self, user_ids: list[int], checkpoints: dict[int, dict], billing_matrix, users_contacts
+    ):
+        """Yield the stage queue and job of each member that resumes from its checkpoint."""
+        for user_id in user_ids:
+            checkpoint = checkpoints.get(user_id)
+            if checkpoint is None:
+                # Missing expenses are a data error, not members without debts
+                result = check_billing_matrix(user_id, billing_matrix)
+                if result:
+                    self._set_result(result)
+                    continue
+                yield self.link_queue, (
+                    user_id, billing_matrix.bill(user_id), users_contacts[user_id]
+                )
+            elif checkpoint["stage"] == LINKED:
+                yield self.message_queue, (
+                    user_id, checkpoint["payment_link"], checkpoint["template_values"],
+                    users_contacts[user_id]
+                )
+            else:
+                # Done in a previous run
+                self._set_result(SendResult(
+                    user_id=user_id, status=checkpoint["stage"],
+                    payment_link=checkpoint["payment_link"] or ""
+                ))
+
+
+    def _linked(self, user_id: int, bill: Bill, user_contact: Contact, payment_link: str):
+        """Get the message job of a member after its link was created, or None if it failed."""
+        result = check_payment_link(user_id, payment_link)
+        if result:
+            self._set_result(result)
+            return None
+        return user_id, payment_link, bill.template_values, user_contact
+
+
+    def _get_results(self, user_ids: list[int]) -> list[SendResult]:
+        """Get the result of each member, in the order of the given IDs."""
+        return [self.results[user_id] for user_id in user_ids]
+
+
+class MonthClosePipeline(MonthCloseStages):
+    """Month close of many members, checkpointed per member in the state store."""
+    def __init__(
+        self,
+        data_access,
+        external_services,
+        workers: int = DEFAULT_WORKERS,
+        queue_size: int = QUEUE_SIZE
+    ):
+        super().__init__(data_access, external_services, workers, queue_size)
+        self.link_queue = queue.Queue(maxsize=self.queue_size)
+        self.message_queue = queue.Queue(maxsize=self.queue_size)
+        self._results_lock = threading.Lock()
+
+
+    def _set_result(self, result: SendResult) -> None:
+        """Keep the result of a member."""
+        with self._results_lock:
+            super()._set_result(result)
+
+
+    def _start_stage(self, function, input_queue: queue.Queue) -> list[threading.Thread]:
+        """Start the workers of a stage, which call the function with each queued member."""
+        def work():
+            while True:
+                job = input_queue.get()
+                if job is _DONE:
+                    return
+                try:
+                    function(*job)
+                # Keep going with the other members. A worker that dies, even on SystemExit,
+                # would leave the stage queue full and the run blocked
+                except BaseException as e:  # pylint: disable=broad-exception-caught
+                    self._set_failure(job[0], e)
+
+        threads = [threading.Thread(target=work, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+
+    def _finish_stage(self, input_queue: queue.Queue, threads: list[threading.Thread]) -> None:
+        """Wait for the workers of a stage to process every queued member."""
+        for _ in threads:
+            input_queue.put(_DONE)
+        for thread in threads:
+            thread.join()
+
+
+    def create_link(self, user_id: int, bill: Bill, user_contact: Contact) -> None:
+        """Link stage: create the payment link of the member bill."""
+        # Members without debts are not checkpointed, so they are billed again on the next run
+        result = check_bill(user_id, bill)
+        if result:
+            self._set_result(result)
+            return
+
+        payment_link, _ = self.external_services.create_payment_link(None, user_id, bill)
+        job = self._linked(user_id, bill, user_contact, payment_link)
+        if job:
+            self.store.save_checkpoint(
+                user_id, LINKED, payment_link, bill.template_values, self.month
+            )
+            self.message_queue.put(job)
+
+
+    def send_message(
+        self, user_id: int, payment_link: str, template_values: dict, user_contact: Contact
+    ) -> None:
+        """Message stage: send the payment link to the member."""
+        result = check_contact(user_id, payment_link, user_contact)
+        if result:
+            self._set_result(result)
+            return
+
+        message_result = self.external_services.send_debt_to_user(
+            user_contact, payment_link, None, template_values
+        )
+        if message_result.sent:
+            self.store.save_checkpoint(user_id, SENT, payment_link, template_values, self.month)
+        self._set_result(get_message_result(user_id, payment_link, message_result))
+
+
+    def run(self, user_ids: list[int]) -> list[SendResult]:
+        """Send the payment links of the month, resuming from the checkpoint of each member."""
+        checkpoints = get_resumable_checkpoints(self.store.get_checkpoints(self.month))
+        users_contacts = self.data_access.get_users_contacts(user_ids)
+
+        # Only fetch the expenses if some member still needs a payment link
+        pending_ids = [user_id for user_id in user_ids if user_id not in checkpoints]
+        billing_matrix = self.data_access.get_billing_matrix(pending_ids) if pending_ids else None
+
+        link_workers = self._start_stage(self.create_link, self.link_queue)
+        message_workers = self._start_stage(self.send_message, self.message_queue)
+        for stage_queue, job in self._route(user_ids, checkpoints, billing_matrix, users_contacts):
+            stage_queue.put(job)
+        self._finish_stage(self.link_queue, link_workers)
+        self._finish_stage(self.message_queue, message_workers)
+        return self._get_results(user_ids)
+
+
+    def settle(self) -> list[Reconciliation]:
+        """Settlement stage: post the reconciled amounts of the new payments to Splitwise."""
+        paid_debts = with_unsettled_payments(self.external_services.get_paid_debts())
+        reconciliations = reconcile(paid_debts)
+        self.data_access.send_payments(get_settlements(reconciliations))
+
+        # The payments not settled stay unsettled in the state store and are retried next run
+        self.external_services.save_payment_cursor()
+        return reconciliations
+
+
+class AsyncMonthClosePipeline(MonthCloseStages):
+    """Month close of many members on an event loop, checkpointed like MonthClosePipeline."""
+    def __init__(
+        self,
+        data_access,
+        external_services,
+        workers: int = MAX_IN_FLIGHT // 2,
+        queue_size: int = QUEUE_SIZE
+    ):
+        super().__init__(data_access, external_services, workers, queue_size)
+
+
+    def _start_stage(self, function, input_queue: asyncio.Queue) -> list[asyncio.Task]:
+        """Start the workers of a stage, which await the function with each queued member."""
+        async def work():
+            while True:
+                job = await input_queue.get()
+                if job is _DONE:
+                    return
+                try:
+                    await function(*job)
+                # Keep going with the other members, letting only the task cancellation through
+                except (Exception, SystemExit) as e:  # pylint: disable=broad-exception-caught
+                    self._set_failure(job[0], e)
+
+        return [asyncio.create_task(work()) for _ in range(self.workers)]
+
+
+    async def _finish_stage(self, input_queue: asyncio.Queue, tasks: list[asyncio.Task]) -> None:
+        """Wait for the workers of a stage to process every queued member."""
+        for _ in tasks:
+            await input_queue.put(_DONE)
+        await asyncio.gather(*tasks)
+
+
+    async def create_link(self, user_id: int, bill: Bill, user_contact: Contact) -> None:
+        """Link stage: create the payment link of the member bill."""
+        result = check_bill(user_id, bill)
+        if result:
+            self._set_result(result)
+            return
+
+        payment_link, _ = await self.external_services.create_payment_link(None, user_id, bill)
+        job = self._linked(user_id, bill, user_contact, payment_link)
+        if job:
+            await run_blocking(
+                self.store.save_checkpoint,
+                user_id, LINKED, payment_link, bill.template_values, self.month
+            )
+            await self.message_queue.put(job)
+
+
+    async def send_message(
+        self, user_id: int, payment_link: str, template_values: dict, user_contact: Contact
+    ) -> None:
+        """Message stage: send the payment link to the member."""
+        result = check_contact(user_id, payment_link, user_contact)
+        if result:
+            self._set_result(result)
+            return
+
+        message_result = await self.external_services.send_debt_to_user(
+            user_contact, payment_link, None, template_values
+        )
+        if message_result.sent:
+            await run_blocking(
+                self.store.save_checkpoint, user_id, SENT, payment_link, template_values, self.month
+            )
+        self._set_result(get_message_result(user_id, payment_link, message_result))
+
+
+    async def run(self, user_ids: list[int]) -> list[SendResult]:
+        """Send the payment links of the month, resuming from the checkpoint of each member."""
+        checkpoints = get_resumable_checkpoints(
+            await run_blocking(self.store.get_checkpoints, self.month)
+        )
+        users_contacts = await self.data_access.get_users_contacts(user_ids)
+
+        # Only fetch the expenses if some member still needs a payment link
+        pending_ids = [user_id for user_id in user_ids if user_id not in checkpoints]
+        billing_matrix = (
+            await self.data_access.get_billing_matrix(pending_ids) if pending_ids else None
+        )
+
+        # The queues belong to the running event loop
+        self.link_queue = asyncio.Queue(maxsize=self.queue_size)
+        self.message_queue = asyncio.Queue(maxsize=self.queue_size)
+        link_workers = self._start_stage(self.create_link, self.link_queue)
+        message_workers = self._start_stage(self.send_message, self.message_queue)
+        for stage_queue, job in self._route(user_ids, checkpoints, billing_matrix, users_contacts):
+            await stage_queue.put(job)
+        await self._finish_stage(self.link_queue, link_workers)
+        await self._finish_stage(self.message_queue, message_workers)
+        return self._get_results(user_ids)
+
+
+    async def settle(self) -> list[Reconciliation]:
+        """Settlement stage: post the reconciled amounts of the new payments to Splitwise."""
+        paid_debts = await run_blocking(
+            with_unsettled_payments, await self.external_services.get_paid_debts()
+        )
+        reconciliations = await run_blocking(reconcile, paid_debts)
+        await self.data_access.send_payments(get_settlements(reconciliations))
+
+        # The payments not settled stay unsettled in the state store and are retried next run
+        await self.external_services.save_payment_cursor()
+        return reconciliations
@@ -0,0 +1,216 @@
+"""
+Rate limits shared by every call to the external APIs.
+
+Each service has a token bucket, which spaces the requests, and an adaptive concurrency
+limit. When a response is throttled (HTTP 429, or a throttling error code of the
+service), the limit is halved and the bucket pauses for the Retry-After delay. Each
+success raises the limit again, up to its maximum. The retries of throttled calls draw
+from a global retry budget, a share of the requests made, so a provider that is down
+never multiplies the traffic. `call_api` applies the limits, so the Data Access Layer and
+the External Services share them.
+"""
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+# Requests per second, burst and maximum concurrency of each service.
+# Override the requests per second with <SERVICE>_RATE_LIMIT on .env (e.g. SPLITWISE_RATE_LIMIT=2)
+DEFAULT_LIMITS = {
+    "splitwise": (5.0, 10, 4),
+    "mercado_pago": (20.0, 40, 10),
+    "whatsapp": (50.0, 80, 10),
+}
+DEFAULT_LIMIT = (10.0, 20, 4)
+
+# Throttling error codes returned with other statuses, by service
+THROTTLE_ERROR_CODES = {
+    # Graph API codes, returned even with a 400 status
+    "whatsapp": {4, 80007, 130429, 131048, 131056},
+}
+
+MAX_THROTTLE_RETRIES = 4
+BACKOFF_SECONDS = 0.5 # Doubled on each retry
+MAX_BACKOFF_SECONDS = 60.0
+RETRY_BUDGET_RATIO = 0.2 # Retries allowed per request made
+RETRY_BUDGET_MIN = 10 # Retries allowed before any request is made
+
+
+def backoff_delay(attempt: int, retry_after: float = None) -> float:
+    """Get the seconds to wait before a retry: the Retry-After delay or a jittered backoff."""
+    if retry_after:
+        return min(retry_after, MAX_BACKOFF_SECONDS)
+    delay = min(BACKOFF_SECONDS * 2 ** (attempt - 1), MAX_BACKOFF_SECONDS)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def parse_retry_after(value) -> float:
+    """Get the seconds of a Retry-After header, in seconds or as an HTTP date."""
+    if not value:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def get_throttle_delay(service: str, result) -> float:
+    """Get the Retry-After seconds of a throttled result or exception, or None if not throttled."""
+    # Mercado Pago SDK responses
+    if isinstance(result, dict):
+        return 0.0 if result.get("status") == 429 else None
+
+    # requests responses and the Splitwise SDK exceptions, whose status may be a tuple
+    status = getattr(result, "status_code", None) or getattr(result, "http_status", None)
+    if isinstance(status, tuple):
+        status = status[0] if status else None
+    headers = getattr(result, "headers", None) or getattr(result, "http_headers", None) or {}
+    if status == 429:
+        return parse_retry_after(headers.get("Retry-After"))
+
+    error_codes = THROTTLE_ERROR_CODES.get(service)
+    if error_codes and hasattr(result, "json"):
+        try:
+            error = result.json().get("error") or {}
+        except (ValueError, AttributeError):
+            return None
+        if error.get("code") in error_codes:
+            return parse_retry_after(headers.get("Retry-After"))
+    return None
+
+
+class TokenBucket:
+    """Token bucket that spaces the requests of a service. A rate of None is unlimited."""
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst or 1)
+        self.tokens = float(self.burst)
+        self.paused_until = 0.0
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def acquire(self) -> None:
+        """Wait for a token."""
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+
+    def pause(self, seconds: float) -> None:
+        """Hold every request for the given seconds and drop the saved burst."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+class ServiceLimiter:
+    """Token bucket and adaptive concurrency limit of a service."""
+    def __init__(self, service: str, rate: float, burst: int, max_concurrency: int):
+        self.service = service
+        self.bucket = TokenBucket(rate, burst)
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = float(self.max_concurrency)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+
+    @contextmanager
+    def slot(self):
+        """Wait for a free request slot and a token of the service."""
+        with self._condition:
+            while self.in_flight >= int(self.concurrency):
+                self._condition.wait()
+            self.in_flight += 1
+        try:
+            self.bucket.acquire()
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify()
+
+
+    def on_success(self) -> None:
+        """Raise the concurrency limit by one request per round of requests."""
+        with self._condition:
+            if self.concurrency < self.max_concurrency:
+                self.concurrency = min(
+                    self.max_concurrency, self.concurrency + 1 / self.concurrency
+                )
+                self._condition.notify()
+
+
+    def on_throttle(self, retry_after: float) -> None:
+        """Halve the concurrency limit and pause the requests for the Retry-After delay."""
+        with self._condition:
+            self.concurrency = max(1.0, self.concurrency / 2)
+        self.bucket.pause(retry_after)
+
+
+class RetryBudget:
+    """Retries shared by every service, limited to a share of the requests made."""
+    def __init__(self, ratio: float = RETRY_BUDGET_RATIO, minimum: int = RETRY_BUDGET_MIN):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.requests = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+
+    def record_request(self) -> None:
+        """Count a first attempt of a request."""
+        with self._lock:
+            self.requests += 1
+
+
+    def try_retry(self) -> bool:
+        """Take a retry from the budget. Return False if the budget is spent."""
+        with self._lock:
+            if self.retries >= self.minimum + self.requests * self.ratio:
+                return False
+            self.retries += 1
+            return True
+
+
+class RateLimiter:
+    """Limiters of every service and the global retry budget."""
+    def __init__(self, limits: dict = None, default_limit: tuple = DEFAULT_LIMIT):
+        self.configure(limits, default_limit)
+
+
+    def configure(self, limits: dict = None, default_limit: tuple = DEFAULT_LIMIT) -> None:
+        """Set the limits of each service, dropping the current limiters and retry budget."""
+        self.limits = DEFAULT_LIMITS if limits is None else limits
+        self.default_limit = default_limit
+        self.retry_budget = RetryBudget()
+        self._limiters: dict[str, ServiceLimiter] = {}
+        self._lock = threading.Lock()
+
+
+    def get(self, service: str) -> ServiceLimiter:
+        """Get the limiter of a service."""
+        with self._lock:
+            if service not in self._limiters:
+                rate, burst, max_concurrency = self.limits.get(service, self.default_limit)
+                rate = float(os.getenv(f"{service.upper()}_RATE_LIMIT") or 0) or rate
+                self._limiters[service] = ServiceLimiter(service, rate, burst, max_concurrency)
+            return self._limiters[service]
+
+
+rate_limiter = RateLimiter()
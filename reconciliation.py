@@ -0,0 +1,122 @@
+"""
+Reconciliation of the approved Mercado Pago payments with the issued payment links.
+
+The payments are joined with the payment links log by external reference, with a hash
+index on each side, so each payment and link is read once. The total of each reference
+is compared with the link total to find partial payments, overpayments and duplicated
+payments, and only the debts actually paid are settled on Splitwise.
+"""
+from fractions import Fraction
+from core import TAX_PERCENT, PaidDebt, Reconciliation, to_cents
+from logger import PAYMENT_LINK_LOG_PATH, read_log
+from state_store import get_month_key, get_state_store
+
+# Statuses of the references that are settled on Splitwise
+SETTLED_STATUSES = ("paid", "partial", "overpaid", "duplicate")
+
+
+def index_payment_links(log_entries: list[dict]) -> dict[str, dict]:
+    """Index the payment links by external reference. The last link of each reference wins."""
+    return {
+        entry["external_ref"]: entry for entry in log_entries if entry.get("external_ref")
+    }
+
+
+def get_debts_cents(link: dict) -> int:
+    """Get the debts of a payment link without taxes, in cents."""
+    if link.get("debts_value") is not None:
+        return to_cents(link["debts_value"])
+    # Links logged before the debts value was recorded: remove the taxes from the total
+    return round(Fraction(to_cents(link["total_value"])) / (1 + Fraction(str(TAX_PERCENT))))
+
+
+def reconcile_reference(
+    external_reference: str, user_id: int, payments: list[dict], link: dict
+) -> Reconciliation:
+    """Compare the payments of a reference with its payment link."""
+    payment_ids = tuple(payment["payment_id"] for payment in payments)
+    paid_cents = sum(to_cents(payment["amount"] or 0) for payment in payments)
+    if link is None:
+        return Reconciliation(
+            external_reference=external_reference, user_id=user_id, status="unmatched",
+            expected_cents=0, paid_cents=paid_cents, settlement_cents=0, payment_ids=payment_ids
+        )
+
+    expected_cents = to_cents(link["total_value"])
+    debts_cents = get_debts_cents(link)
+    if paid_cents > expected_cents:
+        status = "duplicate" if len(payments) > 1 else "overpaid"
+    elif paid_cents < expected_cents:
+        status = "partial"
+    else:
+        status = "paid"
+
+    # Settle the share of the debts that was paid, never more than the debts
+    if paid_cents >= expected_cents or not expected_cents:
+        settlement_cents = debts_cents
+    else:
+        settlement_cents = (2 * paid_cents * debts_cents + expected_cents) // (2 * expected_cents)
+    return Reconciliation(
+        external_reference=external_reference, user_id=user_id, status=status,
+        expected_cents=expected_cents, paid_cents=paid_cents, settlement_cents=settlement_cents,
+        payment_ids=payment_ids
+    )
+
+
+def reconcile(paid_debts: list[PaidDebt], payment_links: list[dict] = None) -> list[Reconciliation]:
+    """Reconcile the paid debts with the issued payment links, one result per reference.
+
+    Every payment recorded for the same references is included, so a payment read on a
+    previous run still counts towards duplicates and overpayments."""
+    if not paid_debts:
+        return []
+    if payment_links is None:
+        payment_links = read_log(PAYMENT_LINK_LOG_PATH)
+    links = index_payment_links(payment_links)
+
+    # Group the payments by reference, keeping the order of the first payment of each one
+    users = {}
+    payments: dict[str, dict[int, dict]] = {}
+    for paid_debt in paid_debts:
+        users.setdefault(paid_debt.external_reference, paid_debt.user_id)
+        payments.setdefault(paid_debt.external_reference, {})[paid_debt.payment_id] = {
+            "payment_id": paid_debt.payment_id, "amount": paid_debt.amount
+        }
+    for payment in get_state_store().get_payments(list(payments)):
+        payments[payment["external_reference"]].setdefault(payment["payment_id"], payment)
+
+    return [
+        reconcile_reference(
+            external_reference, users[external_reference],
+            sorted(reference_payments.values(), key=lambda payment: payment["payment_id"] or 0),
+            links.get(external_reference)
+        )
+        for external_reference, reference_payments in payments.items()
+    ]
+
+
+def get_settlements(reconciliations: list[Reconciliation]) -> list[PaidDebt]:
+    """Get the paid debts to settle on Splitwise, with the reconciled amounts."""
+    return [
+        reconciliation.to_paid_debt()
+        for reconciliation in reconciliations
+        if reconciliation.status in SETTLED_STATUSES and reconciliation.settlement_cents > 0
+    ]
+
+
+def with_unsettled_payments(paid_debts: list[PaidDebt], month: str = None) -> list[PaidDebt]:
+    """Add the payments of the month read by previous runs that were never settled.
+
+    A payment that failed to settle, or whose user or payment link was missing, is already
+    behind the payment cursor, so it is retried from the state store on every run."""
+    paid_debts = list(paid_debts or [])
+    payment_ids = {paid_debt.payment_id for paid_debt in paid_debts}
+    for payment in get_state_store().get_unsettled_payments(month or get_month_key()):
+        if payment["payment_id"] not in payment_ids:
+            paid_debts.append(PaidDebt(
+                user_id=payment["user_id"],
+                external_reference=payment["external_reference"],
+                payment_id=payment["payment_id"],
+                amount=payment["amount"] or 0.0
+            ))
+    return paid_debts
@@ -0,0 +1,423 @@
+"""
+Local state of the monthly payment cycle.
+
+This module keeps the payment links, WhatsApp messages, Mercado Pago payments and Splitwise
+settlements of each month in a SQLite database within the 'state/' directory. The tables are
+indexed by user, month and external reference, so the commands can answer who has a link,
+who paid and who was settled without calling the APIs again.
+"""
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+STATE_DB_PATH = "state/payment_control.db"
+LEGACY_SETTLEMENTS_PATH = "state/settlements.json"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS payment_links (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    external_reference TEXT NOT NULL,
+    payment_link TEXT NOT NULL,
+    total_value REAL,
+    expiration TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_payment_links_user_month ON payment_links (user_id, month);
+CREATE INDEX IF NOT EXISTS idx_payment_links_month ON payment_links (month);
+CREATE INDEX IF NOT EXISTS idx_payment_links_reference ON payment_links (external_reference);
+
+CREATE TABLE IF NOT EXISTS preferences (
+    external_reference TEXT NOT NULL,
+    items_hash TEXT NOT NULL,
+    payment_link TEXT NOT NULL,
+    expiration TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (external_reference, items_hash)
+);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    month TEXT NOT NULL,
+    phone_number TEXT,
+    payment_link TEXT,
+    status TEXT NOT NULL,
+    sent_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_user_month ON messages (user_id, month);
+CREATE INDEX IF NOT EXISTS idx_messages_month ON messages (month);
+
+CREATE TABLE IF NOT EXISTS payments (
+    payment_id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    external_reference TEXT NOT NULL,
+    amount REAL,
+    recorded_at TEXT NOT NULL,
+    settled_at TEXT -- Set once the payment is settled on Splitwise, or needs no settlement
+);
+CREATE INDEX IF NOT EXISTS idx_payments_user_month ON payments (user_id, month);
+CREATE INDEX IF NOT EXISTS idx_payments_month ON payments (month);
+CREATE INDEX IF NOT EXISTS idx_payments_reference ON payments (external_reference);
+
+CREATE TABLE IF NOT EXISTS settlements (
+    external_reference TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    status TEXT NOT NULL,
+    expense_id INTEGER,
+    amount TEXT,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_settlements_user_month ON settlements (user_id, month);
+CREATE INDEX IF NOT EXISTS idx_settlements_month ON settlements (month);
+
+CREATE TABLE IF NOT EXISTS month_close (
+    month TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    payment_link TEXT,
+    template_values TEXT,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (month, user_id)
+);
+"""
+
+
+def get_month_key(date: datetime = None) -> str:
+    """Get the month in the format 'MM_YY', the same used by the external references."""
+    return (date or datetime.now()).strftime("%m_%y")
+
+
+def get_reference_month(external_reference: str) -> str:
+    """Get the 'MM_YY' month of a "{user_id}_{MM_YY}" external reference."""
+    return external_reference.split("_", 1)[1] if "_" in external_reference else ""
+
+
+class StateStore:
+    """SQLite store of the payment cycle state, shared by the threads of a process."""
+    def __init__(self, db_path: str = STATE_DB_PATH):
+        self.db_path = db_path
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Wait for the other processes instead of failing when the database is busy
+        self._connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._transaction() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+        self._add_missing_columns()
+        self._migrate_legacy_settlements()
+
+
+    @contextmanager
+    def _transaction(self):
+        """Run the block in a transaction, holding the connection lock."""
+        with self._lock, self._connection:
+            yield self._connection
+
+
+    def _add_missing_columns(self) -> None:
+        """Add the columns created after the database, which CREATE TABLE doesn't add."""
+        with self._transaction() as connection:
+            columns = {row["name"] for row in connection.execute("PRAGMA table_info(payments)")}
+            if "settled_at" not in columns:
+                connection.execute("ALTER TABLE payments ADD COLUMN settled_at TEXT")
+
+
+    def _migrate_legacy_settlements(self) -> None:
+        """Import the settlements recorded in the legacy JSON ledger."""
+        if not os.path.exists(LEGACY_SETTLEMENTS_PATH):
+            return
+        with open(LEGACY_SETTLEMENTS_PATH, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO settlements "
+                "(external_reference, user_id, month, status, expense_id, amount, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        reference, entry.get("user_id"), get_reference_month(reference),
+                        entry.get("status", "settled"), entry.get("expense_id"),
+                        entry.get("amount"), entry.get("updated_at", datetime.now().isoformat())
+                    )
+                    for reference, entry in entries.items()
+                ]
+            )
+        os.replace(LEGACY_SETTLEMENTS_PATH, f"{LEGACY_SETTLEMENTS_PATH}.migrated")
+
+
+    def record_payment_link(
+        self, user_id, external_reference: str, payment_link: str, total_value, expiration
+    ) -> None:
+        """Record a payment link created for a user."""
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT INTO payment_links (user_id, month, external_reference, payment_link, "
+                "total_value, expiration, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    int(user_id), get_reference_month(external_reference), external_reference,
+                    payment_link, total_value, expiration, datetime.now().isoformat()
+                )
+            )
+
+
+    def cache_preference(
+        self, external_reference: str, items_hash: str, payment_link: str, expiration: str
+    ) -> None:
+        """Cache a Mercado Pago preference by its reference and items."""
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO preferences "
+                "(external_reference, items_hash, payment_link, expiration, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    external_reference, items_hash, payment_link, expiration,
+                    datetime.now().isoformat()
+                )
+            )
+
+
+    def get_cached_preference(
+        self, external_reference: str, items_hash: str, valid_until: datetime
+    ) -> dict:
+        """Get the cached preference of the reference and items, if it is valid until the date."""
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT * FROM preferences WHERE external_reference = ? AND items_hash = ?",
+                (external_reference, items_hash)
+            ).fetchone()
+        if not row or datetime.fromisoformat(row["expiration"]) <= valid_until:
+            return None
+        return dict(row)
+
+
+    def record_message(self, user_id, phone_number: str, payment_link: str, status: str) -> None:
+        """Record a WhatsApp message sent to a user."""
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT INTO messages "
+                "(user_id, month, phone_number, payment_link, status, sent_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    int(user_id) if user_id else None, get_month_key(), phone_number,
+                    payment_link, status, datetime.now().isoformat()
+                )
+            )
+
+
+    def record_payments(self, paid_debts: list) -> None:
+        """Record the approved Mercado Pago payments."""
+        with self._transaction() as connection:
+            # Keep the settled_at of the payments read again
+            connection.executemany(
+                "INSERT INTO payments "
+                "(payment_id, user_id, month, external_reference, amount, recorded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (payment_id) DO UPDATE SET "
+                "user_id = excluded.user_id, month = excluded.month, "
+                "external_reference = excluded.external_reference, amount = excluded.amount",
+                [
+                    (
+                        paid_debt.payment_id, paid_debt.user_id,
+                        get_reference_month(paid_debt.external_reference),
+                        paid_debt.external_reference, paid_debt.amount,
+                        datetime.now().isoformat()
+                    )
+                    for paid_debt in paid_debts
+                    if paid_debt.payment_id is not None
+                ]
+            )
+
+
+    def get_payments(self, external_references: list[str]) -> list[dict]:
+        """Get every recorded payment of the external references."""
+        references = list(set(external_references))
+        payments = []
+        with self._transaction() as connection:
+            # Stay below the SQLite limit of variables per query
+            for i in range(0, len(references), 500):
+                chunk = references[i:i + 500]
+                payments.extend(dict(row) for row in connection.execute(
+                    "SELECT * FROM payments WHERE external_reference IN "
+                    f"({', '.join('?' * len(chunk))}) ORDER BY payment_id",
+                    chunk
+                ))
+        return payments
+
+
+    def get_unsettled_payments(self, month: str = None) -> list[dict]:
+        """Get the recorded payments of the month that were not settled yet."""
+        with self._transaction() as connection:
+            rows = connection.execute(
+                "SELECT * FROM payments WHERE month = ? AND settled_at IS NULL ORDER BY payment_id",
+                (month or get_month_key(),)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+
+    def mark_payments_settled(self, payment_ids: list) -> None:
+        """Mark the payments as settled, so they are not retried on the next runs."""
+        with self._transaction() as connection:
+            connection.executemany(
+                "UPDATE payments SET settled_at = ? WHERE payment_id = ? AND settled_at IS NULL",
+                [
+                    (datetime.now().isoformat(), payment_id)
+                    for payment_id in payment_ids if payment_id is not None
+                ]
+            )
+
+
+    def get_settlement(self, external_reference: str) -> dict:
+        """Get the settlement of an external reference."""
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT * FROM settlements WHERE external_reference = ?", (external_reference,)
+            ).fetchone()
+        return dict(row) if row else None
+
+
+    def reserve_settlement(self, external_reference: str, user_id, settled_amount=None) -> bool:
+        """Mark the settlement as pending. Return False if another run changed it first.
+
+        settled_amount is the amount read from the settled reference, or None if the
+        reference was never settled."""
+        with self._transaction() as connection:
+            if settled_amount is None:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO settlements "
+                    "(external_reference, user_id, month, status, updated_at) "
+                    "VALUES (?, ?, ?, 'pending', ?)",
+                    (
+                        external_reference, int(user_id), get_reference_month(external_reference),
+                        datetime.now().isoformat()
+                    )
+                )
+            else:
+                cursor = connection.execute(
+                    "UPDATE settlements SET status = 'pending', updated_at = ? "
+                    "WHERE external_reference = ? AND status = 'settled' AND amount = ?",
+                    (datetime.now().isoformat(), external_reference, str(settled_amount))
+                )
+        return cursor.rowcount == 1
+
+
+    def complete_settlement(self, external_reference: str, expense_id, amount) -> None:
+        """Mark the settlement as posted to Splitwise, with the total amount settled so far."""
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE settlements SET status = 'settled', expense_id = ?, amount = ?, "
+                "updated_at = ? WHERE external_reference = ?",
+                (expense_id, str(amount), datetime.now().isoformat(), external_reference)
+            )
+
+
+    def release_settlement(self, external_reference: str) -> None:
+        """Undo a pending settlement that failed, so it can be retried."""
+        with self._transaction() as connection:
+            connection.execute(
+                "DELETE FROM settlements "
+                "WHERE external_reference = ? AND status = 'pending' AND amount IS NULL",
+                (external_reference,)
+            )
+            # Keep the amount settled by the previous payments of the reference
+            connection.execute(
+                "UPDATE settlements SET status = 'settled' "
+                "WHERE external_reference = ? AND status = 'pending' AND amount IS NOT NULL",
+                (external_reference,)
+            )
+
+
+    def get_checkpoints(self, month: str = None) -> dict[int, dict]:
+        """Get the month close checkpoint of every user in the month."""
+        with self._transaction() as connection:
+            rows = connection.execute(
+                "SELECT * FROM month_close WHERE month = ?", (month or get_month_key(),)
+            ).fetchall()
+        checkpoints = {}
+        for row in rows:
+            checkpoint = dict(row)
+            checkpoint["template_values"] = json.loads(checkpoint["template_values"] or "{}")
+            checkpoints[checkpoint["user_id"]] = checkpoint
+        return checkpoints
+
+
+    def save_checkpoint(
+        self, user_id, stage: str, payment_link: str = None, template_values: dict = None,
+        month: str = None
+    ) -> None:
+        """Record the last month close stage completed for a user."""
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO month_close "
+                "(month, user_id, stage, payment_link, template_values, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    month or get_month_key(), int(user_id), stage, payment_link,
+                    json.dumps(template_values, ensure_ascii=False) if template_values else None,
+                    datetime.now().isoformat()
+                )
+            )
+
+
+    def get_payment_link(self, user_id, month: str = None) -> dict:
+        """Get the last payment link created for a user in the month."""
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT * FROM payment_links WHERE user_id = ? AND month = ? "
+                "ORDER BY id DESC LIMIT 1",
+                (int(user_id), month or get_month_key())
+            ).fetchone()
+        return dict(row) if row else None
+
+
+    def get_month_status(self, month: str = None) -> list[dict]:
+        """Get the link, message, payment and settlement status of every user in the month."""
+        month = month or get_month_key()
+        with self._transaction() as connection:
+            rows = connection.execute(
+                """
+                WITH users AS (
+                    SELECT user_id FROM payment_links WHERE month = :month
+                    UNION SELECT user_id FROM messages WHERE month = :month AND user_id IS NOT NULL
+                    UNION SELECT user_id FROM payments WHERE month = :month
+                    UNION SELECT user_id FROM settlements WHERE month = :month
+                )
+                SELECT
+                    users.user_id,
+                    (SELECT payment_link FROM payment_links AS l
+                        WHERE l.user_id = users.user_id AND l.month = :month
+                        ORDER BY l.id DESC LIMIT 1) AS payment_link,
+                    (SELECT status FROM messages AS m
+                        WHERE m.user_id = users.user_id AND m.month = :month
+                        ORDER BY m.id DESC LIMIT 1) AS message_status,
+                    (SELECT SUM(amount) FROM payments AS p
+                        WHERE p.user_id = users.user_id AND p.month = :month) AS paid_amount,
+                    (SELECT status FROM settlements AS s
+                        WHERE s.user_id = users.user_id AND s.month = :month) AS settlement_status
+                FROM users
+                ORDER BY users.user_id
+                """,
+                {"month": month}
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+
+_stores: dict[str, StateStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_state_store(db_path: str = STATE_DB_PATH) -> StateStore:
+    """Get the state store shared by every caller of the same database."""
+    with _stores_lock:
+        if db_path not in _stores:
+            _stores[db_path] = StateStore(db_path)
+        return _stores[db_path]
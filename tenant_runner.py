@@ -0,0 +1,93 @@
+"""
+Month close of every tenant in parallel worker processes.
+
+Each tenant runs in a new process, started in the tenant directory with its own .env, so
+its Splitwise token, Mercado Pago and WhatsApp credentials, state store, cache and logs
+never mix with another tenant. A process is never reused for a second tenant, so no
+client, store or rate limiter of the process carries over. The parent only collects the
+result of each tenant.
+"""
+import multiprocessing
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from batch import DEFAULT_WORKERS
+from config.splitwise_config import ACCESS_TOKEN_PATH
+from config.tenants import use_tenant
+from core import Tenant, TenantResult
+from data_access import DataAccess
+from external_services import ExternalServices
+from logger import Logger
+from metrics import metrics
+from pipeline import QUEUE_SIZE, MonthClosePipeline
+
+# Tenants closed at the same time
+DEFAULT_PROCESSES = 4
+# Output of the month close, within the tenant directory
+TENANT_OUTPUT_PATH = "logs/month_close.log"
+
+
+def close_tenant_month(
+    tenant: Tenant, workers: int = DEFAULT_WORKERS, queue_size: int = QUEUE_SIZE
+) -> TenantResult:
+    """Run the month close of every Splitwise friend of the tenant. Runs in a worker process."""
+    try:
+        use_tenant(tenant)
+        # A worker can't ask for the Splitwise authorization
+        if not os.path.exists(ACCESS_TOKEN_PATH):
+            return TenantResult(
+                tenant=tenant.name,
+                error=f"Access token not found. Authorize it with: "
+                      f"main.py --tenant {tenant.name} get-users"
+            )
+
+        os.makedirs(os.path.dirname(TENANT_OUTPUT_PATH), exist_ok=True)
+        with open(TENANT_OUTPUT_PATH, "a", encoding="utf-8") as output, redirect_stdout(output):
+            data_access = DataAccess()
+            external_services = ExternalServices()
+            user_ids = [user["id"] for user in data_access.get_all_users()]
+
+            pipeline = MonthClosePipeline(data_access, external_services, workers, queue_size)
+            with Logger.buffered():
+                results = pipeline.run(user_ids)
+            reconciliations = pipeline.settle()
+            metrics.write_textfile()
+        return TenantResult(tenant=tenant.name, results=results, reconciliations=reconciliations)
+    # Report the failure of the tenant to the parent instead of losing the process
+    except (Exception, SystemExit) as e:  # pylint: disable=broad-exception-caught
+        traceback.print_exc()
+        return TenantResult(tenant=tenant.name, error=str(e) or type(e).__name__)
+
+
+def close_tenants_month(
+    tenants: list[Tenant],
+    processes: int = DEFAULT_PROCESSES,
+    workers: int = DEFAULT_WORKERS,
+    queue_size: int = QUEUE_SIZE
+) -> list[TenantResult]:
+    """Run the month close of every tenant using a bounded process pool."""
+    if not tenants:
+        return []
+    results: dict[str, TenantResult] = {}
+    # Start each process from scratch, without the clients and locks of the parent
+    with ProcessPoolExecutor(
+        max_workers=max(1, min(processes, len(tenants))),
+        mp_context=multiprocessing.get_context("spawn"),
+        max_tasks_per_child=1
+    ) as executor:
+        futures = {
+            executor.submit(close_tenant_month, tenant, workers, queue_size): tenant
+            for tenant in tenants
+        }
+        for future in as_completed(futures):
+            tenant = futures[future]
+            try:
+                results[tenant.name] = future.result()
+            # The process died, e.g. killed by the system
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                results[tenant.name] = TenantResult(
+                    tenant=tenant.name, error=str(e) or type(e).__name__
+                )
+            print(f"Month close of {tenant.name} finished.")
+    return [results[tenant.name] for tenant in tenants]
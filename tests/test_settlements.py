@@ -0,0 +1,119 @@
+"""
+Settlement of the reconciled Mercado Pago payments on Splitwise.
+"""
+import json
+import pytest
+import state_store
+from benchmarks.fakes import CURRENT_USER_ID, FakeBalance, FakeSplitwise
+from core import PaidDebt, format_cents, to_cents
+from data_access.splitwise import send_payments
+from reconciliation import get_settlements, reconcile
+
+USER_ID = CURRENT_USER_ID + 1
+REFERENCE = f"{USER_ID}_10_26"
+LINK = {"external_ref": REFERENCE, "total_value": 101.0, "debts_value": 100.0}
+
+
+class SettlingSplitwise(FakeSplitwise):
+    """Fake Splitwise whose payments lower the balance of the friend, like the real one."""
+    def createExpense(self, expense):  # pylint: disable=invalid-name
+        created, errors = super().createExpense(expense)
+        if created:
+            balance = self.friends[0].balances[0]
+            balance.amount = format_cents(to_cents(balance.amount) - to_cents(expense.getCost()))
+        return created, errors
+
+    @property
+    def posted(self) -> list[str]:
+        """Amounts of the payments posted."""
+        return [expense.getCost() for expense in self.created_expenses]
+
+
+@pytest.fixture(name="store")
+def fixture_store(tmp_path, monkeypatch):
+    """State store in an empty directory."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(state_store, "_stores", {})
+    return state_store.get_state_store()
+
+
+@pytest.fixture(name="splitwise")
+def fixture_splitwise():
+    """Splitwise with one friend who owes the debts of the link."""
+    splitwise = SettlingSplitwise(members=1)
+    splitwise.friends[0].balances = [FakeBalance("100.00")]
+    return splitwise
+
+
+def settle(store, splitwise, payments: list[PaidDebt], link: dict = None) -> None:
+    """Record the payments read on a run, reconcile them and settle them on Splitwise."""
+    store.record_payments(payments)
+    reconciliations = reconcile(payments, [link or LINK])
+    send_payments(splitwise, CURRENT_USER_ID, get_settlements(reconciliations))
+
+
+def payment(payment_id: int, amount: float) -> PaidDebt:
+    """Approved payment of the reference."""
+    return PaidDebt(
+        user_id=USER_ID, external_reference=REFERENCE, payment_id=payment_id, amount=amount
+    )
+
+
+def test_partial_then_full_payment_settles_the_difference(store, splitwise):
+    settle(store, splitwise, [payment(1, 50.5)])
+    settle(store, splitwise, [payment(2, 50.5)])
+
+    assert splitwise.posted == ["50.00", "50.00"]
+    assert splitwise.friends[0].balances[0].amount == "0.00"
+    assert store.get_settlement(REFERENCE)["amount"] == "100.00"
+    assert not store.get_unsettled_payments("10_26")
+
+
+def test_duplicate_payment_is_settled_once(store, splitwise):
+    settle(store, splitwise, [payment(1, 101.0)])
+    settle(store, splitwise, [payment(2, 101.0)])
+
+    assert splitwise.posted == ["100.00"]
+    assert not store.get_unsettled_payments("10_26")
+
+
+def test_settlement_is_capped_at_the_balance(store, splitwise):
+    splitwise.friends[0].balances = [FakeBalance("30.00")]
+    settle(store, splitwise, [payment(1, 101.0)])
+
+    assert splitwise.posted == ["30.00"]
+    assert store.get_settlement(REFERENCE)["amount"] == "30.00"
+
+
+def test_legacy_link_settles_the_total_without_taxes(store, splitwise):
+    settle(store, splitwise, [payment(1, 101.0)], {"external_ref": REFERENCE, "total_value": 101.0})
+
+    assert splitwise.posted == ["100.00"]
+
+
+def test_legacy_settlement_without_amount_is_not_posted_again(store, splitwise, monkeypatch):
+    # Entries of the JSON ledger had no amount and settled the whole balance
+    with open(state_store.LEGACY_SETTLEMENTS_PATH, "w", encoding="utf-8") as f:
+        json.dump({REFERENCE: {"user_id": USER_ID, "expense_id": 1}}, f)
+    monkeypatch.setattr(state_store, "_stores", {})
+    store = state_store.get_state_store()
+
+    settle(store, splitwise, [payment(1, 50.5)])
+    settle(store, splitwise, [payment(2, 50.5)])
+
+    assert not splitwise.posted
+    assert not store.get_unsettled_payments("10_26")
+
+
+def test_failed_payment_keeps_the_amount_settled(store, splitwise):
+    settle(store, splitwise, [payment(1, 50.5)])
+    splitwise.error_rate = 1.0
+    settle(store, splitwise, [payment(2, 50.5)])
+
+    settlement = store.get_settlement(REFERENCE)
+    assert (settlement["status"], settlement["amount"]) == ("settled", "50.00")
+    assert [row["payment_id"] for row in store.get_unsettled_payments("10_26")] == [2]
+
+    splitwise.error_rate = 0.0
+    settle(store, splitwise, [payment(2, 50.5)])
+    assert splitwise.posted == ["50.00", "50.00"]
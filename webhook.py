@@ -0,0 +1,214 @@
+"""
+Receiver of the Mercado Pago payment notifications.
+
+An embedded HTTP server accepts the webhook notifications, answers right away and queues
+the notified payment ID. Settlement workers fetch only that payment from Mercado Pago,
+reconcile it with its payment link and post the settlement to Splitwise, so a payment is
+settled seconds after its approval instead of on the next polling run. The settlement is
+idempotent by external reference, so notifications retried by Mercado Pago are harmless.
+"""
+import hashlib
+import hmac
+import json
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from reconciliation import get_settlements, reconcile
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+WEBHOOK_PATH = "/webhooks/mercado-pago"
+# Secret of the webhook signature, shown on the Mercado Pago application settings
+WEBHOOK_SECRET_ENV = "MERCADO_PAGO_WEBHOOK_SECRET"
+
+
+def get_signature_manifest(payment_id: str, request_id: str, timestamp: str) -> str:
+    """Get the signed template of a notification, as defined by Mercado Pago."""
+    return f"id:{payment_id};request-id:{request_id};ts:{timestamp};"
+
+
+def sign_notification(secret: str, payment_id: str, request_id: str, timestamp: str) -> str:
+    """Get the "x-signature" header of a notification."""
+    signature = hmac.new(
+        secret.encode("utf-8"),
+        get_signature_manifest(payment_id, request_id, timestamp).encode("utf-8"),
+        hashlib.sha256
+    ).hexdigest()
+    return f"ts={timestamp},v1={signature}"
+
+
+def verify_signature(secret: str, headers, payment_id: str) -> bool:
+    """Verify the "x-signature" header of a notification."""
+    parts = dict(
+        part.strip().split("=", 1)
+        for part in (headers.get("x-signature") or "").split(",")
+        if "=" in part
+    )
+    if "ts" not in parts or "v1" not in parts:
+        return False
+    expected = sign_notification(
+        secret, payment_id, headers.get("x-request-id") or "", parts["ts"]
+    )
+    return hmac.compare_digest(expected, f"ts={parts['ts']},v1={parts['v1']}")
+
+
+def get_notified_payment_id(query: dict, body: dict) -> str:
+    """Get the payment ID of a notification, or None if it isn't about a payment."""
+    # Webhooks send "type" and "data.id", the older IPN notifications send "topic" and "id"
+    topic = body.get("type") or body.get("topic") or query.get("type") or query.get("topic")
+    if topic != "payment":
+        return None
+    payment_id = (
+        (body.get("data") or {}).get("id") or query.get("data.id") or query.get("id")
+    )
+    return str(payment_id) if payment_id else None
+
+
+class WebhookServer:
+    """HTTP server that settles the payments notified by Mercado Pago."""
+    def __init__(
+        self,
+        data_access,
+        external_services,
+        host: str = DEFAULT_HOST,
+        port: int = DEFAULT_PORT,
+        workers: int = 2,
+        secret: str = None
+    ):
+        self.data_access = data_access
+        self.external_services = external_services
+        self.secret = secret if secret is not None else os.getenv(WEBHOOK_SECRET_ENV)
+        self.workers = max(1, workers)
+        self.payments = queue.Queue()
+        self._queued_ids = set()
+        self._queued_lock = threading.Lock()
+        self._threads = []
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+
+
+    @property
+    def url(self) -> str:
+        """URL of the webhook endpoint."""
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}{WEBHOOK_PATH}"
+
+
+    def _handler_class(self):
+        """Build the request handler bound to this server."""
+        server = self
+
+        class NotificationHandler(BaseHTTPRequestHandler):
+            """Handler of the Mercado Pago notifications."""
+            def do_POST(self):  # pylint: disable=invalid-name
+                """Queue the notified payment and answer right away."""
+                url = urlparse(self.path)
+                if url.path != WEBHOOK_PATH:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                except json.JSONDecodeError:
+                    body = {}
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                payment_id = get_notified_payment_id(query, body if isinstance(body, dict) else {})
+
+                if payment_id and server.secret and not verify_signature(
+                    server.secret, self.headers, payment_id
+                ):
+                    self.send_response(401)
+                    self.end_headers()
+                    return
+                if payment_id:
+                    server.enqueue(payment_id)
+                # Mercado Pago retries the notifications that aren't answered with 2xx
+                self.send_response(200)
+                self.end_headers()
+
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                """Keep the request log out of the command output."""
+
+        return NotificationHandler
+
+
+    def enqueue(self, payment_id: str) -> None:
+        """Queue the settlement of a payment, unless it is already queued."""
+        with self._queued_lock:
+            if payment_id in self._queued_ids:
+                return
+            self._queued_ids.add(payment_id)
+        self.payments.put(payment_id)
+
+
+    def settle(self, payment_id: str) -> None:
+        """Fetch the notified payment and post its reconciled settlement to Splitwise."""
+        paid_debt = self.external_services.get_paid_debt(payment_id)
+        if not paid_debt:
+            print(f"Payment {payment_id} is not an approved debt payment. Skipping.")
+            return
+        settlements = get_settlements(reconcile([paid_debt]))
+        if settlements:
+            self.data_access.send_payments(settlements)
+        else:
+            print(f"Payment {payment_id} did not match a payment link. Skipping.")
+
+
+    def _work(self) -> None:
+        """Settle the queued payments until the server stops."""
+        while True:
+            payment_id = self.payments.get()
+            if payment_id is None:
+                return
+            try:
+                self.settle(payment_id)
+            # Keep going with the other payments
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                print(f"Failed to settle the payment {payment_id}: {e}")
+            finally:
+                with self._queued_lock:
+                    self._queued_ids.discard(payment_id)
+                self.payments.task_done()
+
+
+    def start(self) -> None:
+        """Start the settlement workers and serve the notifications in the background."""
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(self.workers)
+        ]
+        self._threads.append(threading.Thread(target=self.httpd.serve_forever, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+
+    def stop(self) -> None:
+        """Stop serving and wait for the queued settlements."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for _ in range(self.workers):
+            self.payments.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def send_notification(url: str, payment_id, secret: str = None, timeout: float = 10):
+    """Send a payment notification like Mercado Pago does, to test the webhook locally."""
+    import requests  # pylint: disable=import-outside-toplevel
+
+    request_id = f"simulated-{time.time_ns()}"
+    headers = {"x-request-id": request_id}
+    if secret:
+        headers["x-signature"] = sign_notification(
+            secret, str(payment_id), request_id, str(int(time.time()))
+        )
+    return requests.post(
+        f"{url}?type=payment&data.id={payment_id}",
+        json={"type": "payment", "action": "payment.updated", "data": {"id": str(payment_id)}},
+        headers=headers,
+        timeout=timeout
+    )